@@ -0,0 +1,140 @@
+import numpy as np
+
+
+class CaptureRing:
+    """
+    Preallocated int16 ring of interleaved capture blocks.
+
+    The PortAudio callback copies each block into the next slot exactly once and
+    gets back a sequence number. Consumers look blocks up by that number and read
+    strided per-channel views, so nothing is allocated per block after startup.
+    """
+
+    def __init__(self, slots, frames_per_buffer, channels):
+        self.slots = slots
+        self.frames_per_buffer = frames_per_buffer
+        self.channels = channels
+        self.buffer = np.zeros((slots, frames_per_buffer, channels), dtype=np.int16)
+        self.lengths = np.zeros(slots, dtype=np.int64)
+        self.next_seq = 0
+
+    @staticmethod
+    def slots_for(ms, frames_per_buffer, sample_rate):
+        """Slots needed to hold ms of audio in blocks of frames_per_buffer, at least 4."""
+        return max(4, -(-ms * sample_rate // (1000 * frames_per_buffer)))
+
+    def write(self, in_data):
+        """Copy one interleaved block into the ring, return its sequence number."""
+        seq = self.next_seq
+        self._fill(seq % self.slots, in_data)
+        self.next_seq = seq + 1
+        return seq
+
+    def _fill(self, slot, in_data):
+        samples = np.frombuffer(in_data, dtype=np.int16)
+        frames = min(len(samples) // self.channels, self.frames_per_buffer)
+        self.buffer[slot].reshape(-1)[:frames * self.channels] = samples[:frames * self.channels]
+        self.lengths[slot] = frames
+
+    def is_valid(self, seq):
+        # Keep one slot of slack so a block the writer is filling is never handed out
+        next_seq = self.next_seq
+        return 0 <= seq < next_seq and next_seq - seq < self.slots
+
+    def block(self, seq):
+        """View of all channels of block seq, shape (frames, channels), or None if overwritten."""
+        if not self.is_valid(seq):
+            return None
+        slot = seq % self.slots
+        return self.buffer[slot, :self.lengths[slot]]
+
+    def channel(self, seq, channel):
+        """Strided view of one channel of block seq, or None if overwritten."""
+        if not self.is_valid(seq):
+            return None
+        slot = seq % self.slots
+        return self.buffer[slot, :self.lengths[slot], channel]
+
+
+class ChannelHistory:
+    """Rolling, preallocated history of the most recent samples of a single channel."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=np.int16)
+        self.head = 0 # Index the next sample is written to
+        self.filled = 0
+
+    def write(self, samples):
+        n = len(samples)
+        if n >= self.capacity:
+            self.buffer[:] = samples[n - self.capacity:]
+            self.head = 0
+            self.filled = self.capacity
+            return
+        end = self.head + n
+        if end <= self.capacity:
+            self.buffer[self.head:end] = samples
+        else:
+            split = self.capacity - self.head
+            self.buffer[self.head:] = samples[:split]
+            self.buffer[:n - split] = samples[split:]
+        self.head = end % self.capacity
+        self.filled = min(self.filled + n, self.capacity)
+
+    def tail(self, n):
+        """Contiguous copy of the last n samples (fewer if the history isn't that full yet)."""
+        n = min(n, self.filled)
+        start = (self.head - n) % self.capacity
+        if start + n <= self.capacity:
+            return self.buffer[start:start + n].copy()
+        return np.concatenate((self.buffer[start:], self.buffer[:self.head]))
+
+
+class FrameAccumulator:
+    """
+    Re-cuts blocks of any size into fixed-size frames, carrying the remainder over
+    to the next block. Frames are views of reused buffers, so consume (or copy)
+    each frame before asking for the next, or push_frames()' frames before the
+    next push.
+    """
+
+    def __init__(self, frame_size, dtype=np.int16):
+        self.frame_size = frame_size
+        self.buffer = np.zeros(frame_size, dtype=dtype) # The partial frame carried over
+        self.work = np.zeros(frame_size * 64, dtype=dtype) # Grows to the largest block pushed
+        self.fill = 0
+
+    def push(self, samples):
+        pos = 0
+        n = len(samples)
+        while pos < n:
+            take = min(self.frame_size - self.fill, n - pos)
+            self.buffer[self.fill:self.fill + take] = samples[pos:pos + take]
+            self.fill += take
+            pos += take
+            if self.fill == self.frame_size:
+                self.fill = 0
+                yield self.buffer
+
+    def push_frames(self, samples):
+        """Like push(), but every frame samples completes at once, as a (count, frame_size) view."""
+        n = self.fill + len(samples)
+        if n > len(self.work):
+            self.work = np.zeros(n, dtype=self.work.dtype)
+        self.work[:self.fill] = self.buffer[:self.fill]
+        self.work[self.fill:n] = samples
+        count = n // self.frame_size
+        used = count * self.frame_size
+        self.fill = n - used
+        self.buffer[:self.fill] = self.work[used:n] # Carried in buffer so the view stays intact
+        return self.work[:used].reshape(count, self.frame_size)
+
+    def flush(self):
+        """Return the partial frame left over (possibly empty) and reset."""
+        remainder = self.buffer[:self.fill]
+        self.fill = 0
+        return remainder
+
+    def reset(self):
+        self.fill = 0
@@ -0,0 +1,305 @@
+import collections
+import multiprocessing
+import sys
+import threading
+import time
+import wave
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+import config
+from audio_buffer import CaptureRing, FrameAccumulator
+from vad import WakeGate
+
+logger = config.get_logger('rpi')
+
+
+class SharedCaptureRing(CaptureRing):
+    """
+    CaptureRing in a multiprocessing.shared_memory segment, so capture blocks can
+    be read by other processes without copying or pickling.
+
+    Layout: next_seq, then per slot the block's sequence number, frame count and
+    capture time (time.monotonic(), the same clock in every process on Linux),
+    then the int16 (slots, frames_per_buffer, channels) data. The writer fills a
+    slot before publishing its sequence number and next_seq, and readers check the
+    slot still holds their sequence number after using it (see still_valid()).
+    """
+
+    def __init__(self, name, slots, frames_per_buffer, channels, create=False):
+        self.slots = slots
+        self.frames_per_buffer = frames_per_buffer
+        self.channels = channels
+        self.header_bytes = 8 + slots * 8 * 3
+        size = self.header_bytes + slots * frames_per_buffer * channels * 2
+        if create:
+            try: # Left behind by a crashed run
+                shared_memory.SharedMemory(name=name).unlink()
+            except FileNotFoundError:
+                pass
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=size) if create else self._attach(name)
+        self.owner = create
+        buf = self.shm.buf
+        self._next_seq = np.ndarray((1,), dtype=np.int64, buffer=buf, offset=0)
+        self.seqs = np.ndarray((slots,), dtype=np.int64, buffer=buf, offset=8)
+        self.lengths = np.ndarray((slots,), dtype=np.int64, buffer=buf, offset=8 + slots * 8)
+        self.stamps = np.ndarray((slots,), dtype=np.float64, buffer=buf, offset=8 + slots * 16)
+        self.buffer = np.ndarray((slots, frames_per_buffer, channels), dtype=np.int16, buffer=buf, offset=self.header_bytes)
+        if create:
+            self.next_seq = 0
+            self.seqs[:] = -1
+
+    @staticmethod
+    def _attach(name):
+        # Only the creator may unlink the segment, but before Python 3.13 attaching also
+        # registers it with the resource tracker (shared with the creator), which then
+        # unlinks or complains about it when a worker exits.
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(name=name, track=False)
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+    @property
+    def spec(self):
+        """Arguments for attaching from another process."""
+        return (self.shm.name, self.slots, self.frames_per_buffer, self.channels)
+
+    @classmethod
+    def attach(cls, spec):
+        return cls(*spec)
+
+    @property
+    def next_seq(self):
+        return int(self._next_seq[0])
+
+    @next_seq.setter
+    def next_seq(self, seq):
+        self._next_seq[0] = seq
+
+    def write(self, in_data, captured_at=None):
+        """Copy one interleaved block into the ring, return its sequence number."""
+        seq = self.next_seq
+        slot = seq % self.slots
+        self.seqs[slot] = -1 # Being rewritten
+        self._fill(slot, in_data)
+        self.stamps[slot] = captured_at or time.monotonic()
+        self.seqs[slot] = seq
+        self.next_seq = seq + 1
+        return seq
+
+    def is_valid(self, seq):
+        return super().is_valid(seq) and self.still_valid(seq)
+
+    def still_valid(self, seq):
+        """True if block seq wasn't overwritten while it was being read."""
+        return self.seqs[seq % self.slots] == seq
+
+    def captured_at(self, seq):
+        return float(self.stamps[seq % self.slots])
+
+    def close(self):
+        # Views into the segment have to go before it can be closed
+        del self._next_seq, self.seqs, self.lengths, self.stamps, self.buffer
+        try:
+            self.shm.close()
+        except BufferError: # A caller still holds a view, the mapping goes with the process
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+
+class BusReader:
+    """
+    A consumer's cursor into a SharedCaptureRing. blocks() yields every new
+    sequence number in order, polling every poll_ms while idle; when the reader
+    fell so far behind that blocks were overwritten it skips ahead and counts them.
+    """
+
+    def __init__(self, ring, poll_ms=config.AUDIO_BUS_POLL_MS):
+        self.ring = ring
+        self.poll = poll_ms / 1000
+        self.cursor = ring.next_seq
+        self.skipped = 0
+
+    def blocks(self, stop=None):
+        while stop is None or not stop.is_set():
+            next_seq = self.ring.next_seq
+            if self.cursor >= next_seq:
+                time.sleep(self.poll)
+                continue
+            oldest = next_seq - self.ring.slots + 1
+            if self.cursor < oldest:
+                self.skipped += oldest - self.cursor
+                self.cursor = oldest
+            seq = self.cursor
+            self.cursor += 1
+            if self.ring.is_valid(seq):
+                yield seq
+
+
+def wake_worker(spec, channel, results, stop):
+    """Run porcupine on one channel of the bus, reporting detections as ('wake', channel, seq, end, keyword, captured_at)."""
+    import pvporcupine
+    ring = SharedCaptureRing.attach(spec)
+    porcupine = pvporcupine.create(access_key=config.ACCESS_KEY, keyword_paths=config.KEYWORD_PATHS)
+    frames = FrameAccumulator(porcupine.frame_length)
+    gate = WakeGate(porcupine.frame_length) if config.WAKE_GATE_ENABLED else None
+    reader = BusReader(ring)
+    try:
+        for seq in reader.blocks(stop):
+            samples = ring.channel(seq, channel)
+            # A frame may have started in the previous block, so frame i ends at (i + 1) * frame_length - carried within this one
+            carried = frames.fill
+            block = frames.push_frames(samples)
+            for i, frame in gate.process(block) if gate else enumerate(block):
+                keyword = porcupine.process(frame)
+                if keyword >= 0:
+                    results.put(('wake', channel, seq, (i + 1) * porcupine.frame_length - carried, keyword, ring.captured_at(seq)))
+            if not ring.still_valid(seq):
+                reader.skipped += 1
+    finally:
+        porcupine.delete()
+        ring.close()
+
+
+class WakeVoter:
+    """
+    Combines wake-word detections from several channels into one trigger.
+
+    With rule 'any' the first detection on any channel triggers. With 'votes'
+    detections on min_votes distinct channels within window_s are needed, except
+    on the primary channel (the beamformed one), which always triggers at once so
+    the ensemble never delays it. After a trigger, detections within window_s are
+    the same utterance and are ignored.
+    """
+
+    def __init__(self, rule=config.WAKE_ENSEMBLE_RULE, min_votes=config.WAKE_ENSEMBLE_MIN_VOTES,
+                 window_s=config.WAKE_ENSEMBLE_WINDOW_MS / 1000, primary=config.INTERESTED_CHANNEL):
+        self.rule = rule
+        self.min_votes = min_votes
+        self.window_s = window_s
+        self.primary = primary
+        self.votes = {} # channel: time of its latest detection
+        self.quiet_until = 0.0
+        self.detections = collections.Counter()
+        self.voters = () # Channels that made the last trigger
+
+    def vote(self, channel, at):
+        """Record a detection on channel at time at (monotonic), return True if it triggers."""
+        self.detections[channel] += 1
+        if at < self.quiet_until:
+            return False
+        self.votes = {ch: t for ch, t in self.votes.items() if at - t <= self.window_s}
+        self.votes[channel] = at
+        if self.rule == 'any' or channel == self.primary or len(self.votes) >= self.min_votes:
+            self.voters = tuple(sorted(self.votes))
+            self.votes.clear()
+            self.quiet_until = at + self.window_s
+            return True
+        return False
+
+
+def record_worker(spec, path, results, stop):
+    """Write every channel of the bus to a WAV file, for debugging."""
+    ring = SharedCaptureRing.attach(spec)
+    reader = BusReader(ring)
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(ring.channels)
+        wav.setsampwidth(2)
+        wav.setframerate(config.SAMPLE_RATE)
+        for seq in reader.blocks(stop):
+            block = ring.block(seq)
+            if block is not None:
+                wav.writeframes(block.tobytes())
+    ring.close()
+
+
+class BusSupervisor:
+    """
+    Runs worker processes attached to a SharedCaptureRing and restarts any that
+    die, with exponential backoff that resets once a worker stayed up a minute.
+    Workers are called as target(ring.spec, *args, results, stop) in a spawned
+    process; what they put on `results` is handed to on_result on a thread of
+    this process.
+
+    A spawned child re-runs the main script (as __mp_main__) before it unpickles
+    its target, so the script should keep imports workers don't need under its
+    `if __name__ == "__main__"` guard, as audio_controller.py does.
+    """
+
+    def __init__(self, ring, on_result=None, restart_max_s=config.AUDIO_BUS_RESTART_MAX_S):
+        self.ring = ring
+        self.on_result = on_result
+        self.restart_max_s = restart_max_s
+        self.context = multiprocessing.get_context('spawn') # Don't fork PortAudio/GStreamer state
+        self.results = self.context.Queue()
+        self.stop_event = self.context.Event()
+        self.workers = {} # name: {"target", "args", "process", "started", "backoff", "restarts"}
+        self.running = False
+
+    def add(self, name, target, *args):
+        self.workers[name] = {'target': target, 'args': args, 'process': None, 'started': 0.0, 'backoff': 1.0,
+                              'restarts': 0, 'restart_at': 0.0}
+
+    def start(self):
+        self.running = True
+        for name in self.workers:
+            self._spawn(name)
+        threading.Thread(target=self._watch, name='bus-supervisor', daemon=True).start()
+        threading.Thread(target=self._results, name='bus-results', daemon=True).start()
+
+    def _spawn(self, name):
+        worker = self.workers[name]
+        process = self.context.Process(target=worker['target'], name=f'bus-{name}', daemon=True,
+                                       args=(self.ring.spec, *worker['args'], self.results, self.stop_event))
+        process.start()
+        worker['process'] = process
+        worker['started'] = time.monotonic()
+        logger.info(f"Audio bus worker {name} started (pid {process.pid})")
+
+    def _watch(self):
+        while self.running:
+            time.sleep(0.5)
+            now = time.monotonic()
+            for name, worker in self.workers.items():
+                process = worker['process']
+                if process is None or process.is_alive() or not self.running:
+                    continue
+                if not worker['restart_at']:
+                    uptime = now - worker['started']
+                    if uptime > 60:
+                        worker['backoff'] = 1.0
+                    worker['restart_at'] = now + worker['backoff']
+                    logger.error(f"Audio bus worker {name} exited with {process.exitcode} after {uptime:.1f}s, "
+                                 f"restarting in {worker['backoff']:.0f}s")
+                    worker['backoff'] = min(worker['backoff'] * 2, self.restart_max_s)
+                elif now >= worker['restart_at']:
+                    worker['restart_at'] = 0.0
+                    worker['restarts'] += 1
+                    self._spawn(name)
+
+    def _results(self):
+        while self.running:
+            try:
+                result = self.results.get(timeout=0.5)
+            except Exception: # queue.Empty, or the queue closed on shutdown
+                continue
+            if self.on_result:
+                self.on_result(result)
+
+    @property
+    def restarts(self):
+        return sum(worker['restarts'] for worker in self.workers.values())
+
+    def stop(self, timeout=2):
+        self.running = False
+        self.stop_event.set()
+        for worker in self.workers.values():
+            process = worker['process']
+            if process is not None:
+                process.join(timeout)
+                if process.is_alive():
+                    process.terminate()
@@ -1,20 +1,30 @@
 import asyncio
 from enum import Enum
 import logging
-import numpy as np
-import pyaudio
-import pvporcupine
-import usb.core
-import usb.util
-import websockets
-from concurrent.futures import ThreadPoolExecutor
+import time
 import config
-import queue
 import json
-from trace_id import with_trace, get_trace_id, set_trace_id
-from speaker_controller import SpeakerController
-from pixel_ring import PixelRing
-from usb_4_mic_array.tuning import Tuning
+from trace_id import with_trace, get_trace_id, set_trace_id, spans
+from metrics import LatencyStats, EventCounter, Histogram, registry
+from loop_monitor import LoopLagMonitor, LoopWatchdog
+from audio_buffer import CaptureRing, ChannelHistory, FrameAccumulator
+from audio_bus import SharedCaptureRing, BusSupervisor, WakeVoter, wake_worker, record_worker
+from codec import create_codec
+from uplink import UplinkSender, Utterance
+from vad import StreamingVAD, WakeGate
+from usb_scheduler import UsbScheduler
+
+if __name__ == "__main__":
+    # Audio bus workers are spawned, which re-runs this script as __mp_main__ in each
+    # of them; only the main process needs the audio device, USB, GStreamer and network
+    import pyaudio
+    import pvporcupine
+    import usb.core
+    import usb.util
+    import websockets
+    from speaker_controller import SpeakerController
+    from pixel_ring import PixelRing
+    from usb_4_mic_array.tuning import Tuning
 
 # Apply the configuration
 logger = config.get_logger('rpi')
@@ -29,29 +39,98 @@ class WSMessages(Enum):
 class AudioController:
     def __init__(self):
         self.speaker = SpeakerController()
-        self.respeaker = self.initialize_respeaker() # also sets self.pixel_ring
+        self.respeaker = self.initialize_respeaker() # also sets self.usb and self.pixel_ring
         if not self.respeaker:
             logger.error("ReSpeaker initialization failed")
             exit(1)
         self.pixel_ring.off() # Normally off
-        self.porcupine = pvporcupine.create(access_key=config.ACCESS_KEY, keyword_paths=config.KEYWORD_PATHS)
-        self.porcupine_frame_length = self.porcupine.frame_length
+        self.porcupine = None if config.AUDIO_BUS_ENABLED else pvporcupine.create(access_key=config.ACCESS_KEY, keyword_paths=config.KEYWORD_PATHS)
+        self.porcupine_frame_length = self.porcupine.frame_length if self.porcupine else 0
+        self.wake_gate = WakeGate(self.porcupine_frame_length) if self.porcupine and config.WAKE_GATE_ENABLED else None
+        self.wake_frames = FrameAccumulator(self.porcupine_frame_length or 1)
+        self.wake_latency = LatencyStats('wake_detect') # From the end of the wake word being captured to its detection
         self.stt_ip = config.STT_IP
         self.stt_port = config.STT_PORT
         self.is_streaming = False
         self.audio = pyaudio.PyAudio()
         self.stream = None
-        self.ws = None
+        self.frames_per_buffer = config.FRAMES_PER_BUFFER
+        ring_slots = CaptureRing.slots_for(config.CAPTURE_RING_MS, self.frames_per_buffer, config.SAMPLE_RATE)
+        self.bus = None
+        self.voter = WakeVoter()
+        if config.AUDIO_BUS_ENABLED or config.WAKE_ENSEMBLE_CHANNELS:
+            self.capture_ring = SharedCaptureRing(config.AUDIO_BUS_NAME, ring_slots, self.frames_per_buffer, config.CHANNELS, create=True)
+            self.bus = BusSupervisor(self.capture_ring, self.on_bus_result)
+            if config.AUDIO_BUS_ENABLED:
+                self.bus.add('wake', wake_worker, config.INTERESTED_CHANNEL)
+            for channel in config.WAKE_ENSEMBLE_CHANNELS:
+                self.bus.add(f'wake{channel}', wake_worker, channel)
+            if config.AUDIO_BUS_RECORD_PATH:
+                self.bus.add('recorder', record_worker, config.AUDIO_BUS_RECORD_PATH)
+        else:
+            self.capture_ring = CaptureRing(ring_slots, self.frames_per_buffer, config.CHANNELS)
+        self.last_seq = -1 # Last capture block processed
+        self.ring_overruns = 0
+        self.history = ChannelHistory(config.SAMPLE_RATE * config.AUDIO_BUFFER_MS // 1000)
+        self.preroll_samples = config.SAMPLE_RATE * config.WAKE_PREROLL_MS // 1000
+        self.codec = create_codec(config.UPLINK_CODEC)
+        self.uplink_frames = FrameAccumulator(config.SAMPLE_RATE * config.UPLINK_FRAME_MS // 1000)
+        self.uplink = UplinkSender(f'ws://{self.stt_ip}:{self.stt_port}')
+        self.vad = StreamingVAD() if config.VAD_SOURCE == 'host' else None
         self.silence_task = None
-        self.executor = ThreadPoolExecutor(max_workers=1)
-        self.audio_queue = queue.Queue()
+        self.response_trace = None # Trace of the response playing
+        self.loop = None
+        self.audio_queue = asyncio.Queue()
+        self.queue_wait = LatencyStats('audio_queue_wait')
+        self.input_overflows = 0
+        self.input_underflows = 0
+        self.porcupine_time = Histogram('porcupine_process', buckets=(0.0005, 0.001, 0.002, 0.004, 0.008, 0.016, 0.032, 0.064))
+        self.wake_detections = 0
+        self.loop_monitor = LoopLagMonitor()
+        self.watchdog = LoopWatchdog(self.loop_monitor)
+        # Per-chunk and per-message events are counted, not logged one by one
+        self.uplink_events = EventCounter(logger, 'uplink', config.HOTPATH_LOG_SAMPLE_EVERY)
+        self.downlink_events = EventCounter(logger, 'downlink', config.HOTPATH_LOG_SAMPLE_EVERY)
+
+    def register_metrics(self):
+        registry.gauge('device_info', "Always 1, labelled with the device id", lambda: 1, device_id=config.DEVICE_ID)
+        registry.gauge('audio_queue_depth', "Capture blocks waiting for the event loop", self.audio_queue.qsize)
+        registry.latency('audio_queue_wait_seconds', "Time capture blocks waited for the event loop", self.queue_wait)
+        registry.counter('capture_ring_overruns_total', "Capture blocks overwritten before they were processed", lambda: self.ring_overruns)
+        registry.counter('input_overflows_total', "PortAudio callbacks flagged with input overflow", lambda: self.input_overflows)
+        registry.counter('input_underflows_total', "PortAudio callbacks flagged with input underflow", lambda: self.input_underflows)
+        registry.histogram('porcupine_process_seconds', "Time of one porcupine.process call", self.porcupine_time)
+        if self.wake_gate:
+            registry.gauge('wake_gate_pass_ratio', "Porcupine calls per frame captured since startup", lambda: self.wake_gate.pass_ratio)
+        registry.latency('wake_detect_seconds', "Time from the end of the wake word being captured to its detection", self.wake_latency)
+        registry.counter('wake_detections_total', "Wake words detected", lambda: self.wake_detections)
+        registry.latency('ws_send_seconds', "Time of one STT WebSocket send", self.uplink.send_latency)
+        registry.latency('uplink_queue_wait_seconds', "Time messages waited in the uplink queue", self.uplink.queue_latency)
+        registry.counter('ws_sent_bytes_total', "Bytes sent on the STT WebSocket", lambda: self.uplink.bytes_sent)
+        registry.gauge('uplink_queue_depth', "Messages waiting in the uplink queue", lambda: self.uplink.depth)
+        registry.counter('uplink_dropped_total', "Audio frames dropped by the uplink overflow policy", lambda: self.uplink.dropped)
+        registry.counter('ws_reconnects_total', "STT WebSocket reconnects", lambda: self.uplink.reconnects)
+        registry.latency('ws_downtime_seconds', "Time the STT WebSocket was down before each reconnect", self.uplink.downtime)
+        for kind in UsbScheduler.KINDS.values():
+            registry.latency('usb_transfer_seconds', "Time of one USB control transfer", self.usb.transfer[kind], kind=kind)
+            registry.latency('usb_latency_seconds', "Time from queueing a USB control transfer to its completion", self.usb.latency[kind], kind=kind)
+        if self.bus:
+            registry.counter('audio_bus_restarts_total', "Audio bus worker restarts", lambda: self.bus.restarts)
+        for channel in {config.INTERESTED_CHANNEL, *config.WAKE_ENSEMBLE_CHANNELS}:
+            registry.counter('wake_channel_detections_total', "Wake word detections per capture channel",
+                             lambda channel=channel: self.voter.detections[channel], channel=channel)
+        registry.histogram('loop_lag_seconds', "Event loop wake-up lag", self.loop_monitor.histogram)
+        registry.counter('loop_stalls_total', "Times the event loop was blocked past LOOP_BLOCKED_WARN_S", lambda: self.watchdog.stalls)
+        registry.latency('loop_blocked_seconds', "Length of event loop stalls", self.watchdog.blocked)
 
     def initialize_respeaker(self):
         try:
             dev = usb.core.find(idVendor=config.RESPEAKER_ID_VENDOR, idProduct=config.RESPEAKER_ID_PRODUCT)
             if dev:
-                self.pixel_ring = PixelRing(dev)
-                return Tuning(dev)
+                self.usb = UsbScheduler(dev)
+                # One stuck transfer holds up every other on the scheduler thread, so keep them short
+                self.pixel_ring = PixelRing(dev, scheduler=self.usb, timeout=config.USB_TRANSFER_TIMEOUT_MS)
+                return Tuning(dev, timeout=config.USB_TRANSFER_TIMEOUT_MS)
             else:
                 logger.warning("ReSpeaker device not found")
                 return None
@@ -65,81 +144,169 @@ class AudioController:
             self.stream.close()
         
         self.stream = self.audio.open(
-            rate=16000,
-            channels=6,
+            rate=config.SAMPLE_RATE,
+            channels=config.CHANNELS,
             format=pyaudio.paInt16,
             input=True,
-            frames_per_buffer=4096,
+            frames_per_buffer=self.frames_per_buffer,
             stream_callback=self.audio_callback
         )
         logger.info("Audio stream opened")
 
     def audio_callback(self, in_data, frame_count, time_info, status):
-        self.audio_queue.put(in_data)
+        # Runs on the PortAudio thread: copy into the ring once, hand the slot over to the event loop
+        seq = self.capture_ring.write(in_data)
+        if status & pyaudio.paInputOverflow:
+            self.input_overflows += 1
+        if status & pyaudio.paInputUnderflow:
+            self.input_underflows += 1
+        try:
+            self.loop.call_soon_threadsafe(self.audio_queue.put_nowait, (seq, time.monotonic()))
+        except RuntimeError: # Event loop already closed, we're shutting down
+            return (None, pyaudio.paAbort)
         return (None, pyaudio.paContinue)
 
     async def process_audio_queue(self):
         while True:
-            try:
-                in_data = self.audio_queue.get_nowait()
-                await self.process_audio(in_data)
-            except queue.Empty:
-                await asyncio.sleep(0.01)  # Short sleep to prevent busy-waiting
+            seq, captured_at = await self.audio_queue.get()
+            self.queue_wait.observe(time.monotonic() - captured_at)
+            if isinstance(seq, tuple): # A result from an audio bus worker
+                await self.on_bus_wake(seq)
+            else:
+                await self.process_audio(seq, captured_at)
 
     @with_trace
-    async def process_audio(self, in_data):
-        audio_array = np.frombuffer(in_data, dtype=np.int16).reshape(-1, 6)
-        channel_0 = audio_array[:, 0]
-        if not self.is_streaming:
-            for i in range(0, len(channel_0), self.porcupine_frame_length):
-                porcupine_chunk = channel_0[i:i + self.porcupine_frame_length]
-                
-                if len(porcupine_chunk) == self.porcupine_frame_length:
-                    result = self.porcupine.process(porcupine_chunk)
-                    if result >= 0:
-                        trace_id = set_trace_id()
-                        logger.info("Wake word detected!", extra={"trace_id": trace_id})
-                        self.pixel_ring.listen()
-                        await self.send_message(message_type=WSMessages.CONTROL_TYPE.value, message=WSMessages.START_MSG.value)
-                        self.start_silence_detection()
-                        self.is_streaming = True
-                        break
+    async def process_audio(self, seq, captured_at=None):
+        channel_0 = self.capture_ring.channel(seq, config.INTERESTED_CHANNEL)
+        if channel_0 is None:
+            self.ring_overruns += 1
+            logger.warning(f"Capture block {seq} overwritten before processing ({self.ring_overruns} total)")
+            return
+        self.history.write(channel_0)
+        if self.vad:
+            self.vad.process(channel_0) # Always on, so the noise floor is settled before the wake word
+        self.last_seq = seq
+        if not self.is_streaming and self.porcupine is not None: # With the audio bus a worker process does this
+            # Frames straddling two capture buffers are carried over, so any FRAMES_PER_BUFFER works.
+            # Frame i ends (i + 1) * frame_length - carried into this block; the gate takes them all at once.
+            carried = self.wake_frames.fill
+            frames = self.wake_frames.push_frames(channel_0)
+            for i, porcupine_chunk in self.wake_gate.process(frames) if self.wake_gate else enumerate(frames):
+                start = time.perf_counter()
+                result = self.porcupine.process(porcupine_chunk)
+                self.porcupine_time.observe(time.perf_counter() - start)
+                if result >= 0:
+                    self.voter.vote(config.INTERESTED_CHANNEL, time.monotonic()) # So the ensemble doesn't fire again for it
+                    # Whatever followed the wake word in this block is already in the history
+                    remainder = len(channel_0) - ((i + 1) * self.porcupine_frame_length - carried)
+                    if captured_at:
+                        self.wake_latency.observe(time.monotonic() - captured_at + remainder / config.SAMPLE_RATE)
+                    await self.start_utterance(remainder)
+                    return
         else:
             if self.is_streaming:
-                await self.stream_audio_chunk(channel_0.tobytes())
+                await self.stream_audio_chunk(channel_0)
+            if self.vad and self.vad.trailing_silence_ms >= config.NO_VOICE_TRIGGER * 1000:
+                logger.info(f"Silence detected for {config.NO_VOICE_TRIGGER} seconds (host VAD). Stopping stream.")
+                await self.end_utterance()
 
 
-    async def connect_websocket(self):
+    async def start_utterance(self, remainder):
+        """Wake word: open a session and send the pre-roll plus the remainder samples captured since the detection."""
+        self.wake_detections += 1
+        trace_id = set_trace_id()
+        spans.mark('wake', trace_id)
+        self.downlink_events.flush() # Whatever the server sent for the previous utterance
+        for summary in spans.finish_all(keep=trace_id): # Interrupted or never answered
+            self.log_spans(summary)
+        logger.info(f"Wake word detected! ({self.wake_latency.summary()}, {self.frames_per_buffer} frames per buffer)", extra={"trace_id": trace_id})
+        if config.BARGE_IN_MODE != 'off' and self.speaker.is_playing:
+            self.speaker.interrupt(config.BARGE_IN_MODE) # Before anything else, it's the user talking over us
+        self.speaker.play_earcon('wake', trace_id)
+        self.pixel_ring.listen()
+        self.wake_frames.reset() # Porcupine picks up on fresh audio after the utterance
+        self.codec.reset()
+        self.uplink_frames.reset()
+        await self.send_message(message_type=WSMessages.CONTROL_TYPE.value, message=WSMessages.START_MSG.value, audio=self.codec.describe(), utterance=Utterance.START)
+        self.is_streaming = True
+        if self.vad:
+            self.vad.start_utterance()
+        await self.stream_audio_chunk(self.history.tail(self.preroll_samples + remainder))
+        self.start_silence_detection()
+
+    def on_bus_result(self, result):
+        # Runs on the supervisor's results thread, queued behind the capture blocks already waiting
         try:
-            self.ws = await websockets.connect(f'ws://{self.stt_ip}:{self.stt_port}')
-            logger.info("Successfully connected to Speech-To-Text WebSocket")
-        except Exception as e:
-            logger.error(f"Failed to connect to WebSocket: {e}")
-            raise
+            self.loop.call_soon_threadsafe(self.audio_queue.put_nowait, (result, time.monotonic()))
+        except RuntimeError: # Event loop already closed, we're shutting down
+            pass
+
+    async def on_bus_wake(self, result):
+        _, channel, seq, end, keyword, captured_at = result
+        logger.debug(f"Wake word on channel {channel} in block {seq}, {(time.monotonic() - captured_at) * 1000:.0f}ms after capture")
+        if not self.voter.vote(channel, captured_at) or self.is_streaming:
+            return
+        if len(self.voter.voters) > 1 or channel != config.INTERESTED_CHANNEL:
+            logger.info(f"Wake word ensemble triggered by channels {self.voter.voters}")
+        # Blocks processed since the detection are in the history; later ones get streamed as they come
+        remainder = (self.last_seq - seq) * self.frames_per_buffer + self.frames_per_buffer - end if self.last_seq >= seq else 0
+        await self.start_utterance(remainder)
+
+    async def connect_websocket(self):
+        await self.uplink.connect()
+        logger.info("Successfully connected to Speech-To-Text WebSocket")
 
     @with_trace
-    async def send_message(self, message_type: str, message):
+    async def send_message(self, message_type: str, message, utterance=None, **fields):
+        """Queue a message for the uplink sender task, returns False if the audio queue overflowed."""
         trace_id = get_trace_id()
-        try:
-            if self.ws and message_type == WSMessages.CONTROL_TYPE.value:
-                wsmessage = json.dumps({"type": message_type, "message": message, "source_ip": config.IP_ADDRESS, "trace_id": trace_id})
-                await self.ws.send(wsmessage)
-            elif self.ws and message_type == WSMessages.AUDIO_TYPE.value:
-                #wsmessage = json.dumps({"type": message_type, "message": message})
-                await self.ws.send(message) #Cant encode the raw audio bytes to json
-            if not self.ws:
-                logger.error("WebSocket not connected")
-        except Exception as e:
-            logger.error(f"Error sending message: {e}")
+        if message_type == WSMessages.CONTROL_TYPE.value:
+            wsmessage = json.dumps({"type": message_type, "message": message, "source_ip": config.IP_ADDRESS, "trace_id": trace_id, **fields})
+            self.uplink.put_control(wsmessage, utterance, trace_id)
+        elif message_type == WSMessages.AUDIO_TYPE.value:
+            return self.uplink.put_audio(message) #Cant encode the raw audio bytes to json
+        return True
 
-    async def stream_audio_chunk(self, audio_chunk):
-        if self.ws:
-            logger.debug("Sending audio chunk")
-            await self.send_message(WSMessages.AUDIO_TYPE.value, audio_chunk)
-        else:
-            logger.error("Audio WebSocket not connected")
+    async def stream_audio_chunk(self, samples):
+        # Queued even while disconnected, the uplink replays it once the socket is back
+        trace_id = get_trace_id()
+        for frame in self.uplink_frames.push(samples):
+            payload = self.codec.encode(frame)
+            if not len(payload):
+                continue
+            self.uplink_events.event('audio_chunk', len(payload), trace_id)
+            if not await self.send_message(WSMessages.AUDIO_TYPE.value, payload):
+                self.uplink_events.event('overflow', trace_id=trace_id)
+                logger.warning("Uplink can't keep up, ending utterance")
+                await self.end_utterance()
+                self.speaker.play_earcon('error') # Instead of the stop earcon
+                return
+
+    async def end_utterance(self):
+        if not self.is_streaming:
+            return
+        self.speaker.play_earcon('stop')
+        self.speaker.unduck()
+        self.pixel_ring.think()
+        self.is_streaming = False
+        while not self.audio_queue.empty():
+            try:
+                self.audio_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+        tail = self.codec.encode(self.uplink_frames.flush()) if self.uplink_frames.fill else b''
+        tail = bytes(tail) + self.codec.flush()
+        if tail:
+            await self.send_message(WSMessages.AUDIO_TYPE.value, tail)
+        await self.send_message(WSMessages.CONTROL_TYPE.value, WSMessages.STOP_MSG.value, utterance=Utterance.STOP)
+        self.uplink_events.flush(get_trace_id())
+        logger.info(self.queue_wait.summary())
+        logger.info(self.uplink.summary())
+        logger.info(self.usb.summary())
 
     def start_silence_detection(self):
+        if self.vad:
+            return # Endpointing happens per frame in process_audio
         if self.silence_task is None or self.silence_task.done():
             self.silence_task = asyncio.create_task(self.silence_detection())
 
@@ -147,20 +314,18 @@ class AudioController:
         silence_duration = 0
         while self.is_streaming:
             if self.respeaker:
-                future = self.executor.submit(self.respeaker.is_voice)
-                is_voice = await asyncio.wrap_future(future)
+                try:
+                    is_voice = await self.usb.run(self.respeaker.is_voice, priority=UsbScheduler.READ, timeout=config.USB_READ_TIMEOUT_S)
+                except asyncio.TimeoutError:
+                    # Counted as silence, so a stuck transfer can't hold the utterance open
+                    logger.warning(f"VAD read timed out after {config.USB_READ_TIMEOUT_S}s")
+                    silence_duration += config.USB_READ_TIMEOUT_S
+                    is_voice = False
                 if not is_voice:
                     silence_duration += 0.1
                     if silence_duration >= config.NO_VOICE_TRIGGER:
                         logger.info(f"Silence detected for {config.NO_VOICE_TRIGGER} seconds. Stopping stream.")
-                        self.pixel_ring.think()
-                        self.is_streaming = False
-                        while not self.audio_queue.empty():
-                            try:
-                                self.audio_queue.get_nowait()
-                            except queue.Empty:
-                                break
-                        await self.send_message(WSMessages.CONTROL_TYPE.value, WSMessages.STOP_MSG.value)
+                        await self.end_utterance()
                         break
                 else:
                     silence_duration = 0
@@ -168,50 +333,76 @@ class AudioController:
         logger.info("Silence detection task ended")
 
     @with_trace
-    async def listener(self, websocket):
-        self.ws = websocket
+    async def listener(self):
         while True:
+            ws = await self.uplink.wait_connected()
             try:
-                msg = await self.ws.recv()
+                msg = await ws.recv()
                 msg = json.loads(msg)
+                self.uplink.ack()
                 if 'trace_id' in msg:
                     trace_id = msg['trace_id']
                 else:
                     trace_id = get_trace_id()
                 if 'url' in msg:
                     url = msg['url']
+                    spans.mark('url', trace_id)
+                    self.response_trace = trace_id
                     logger.info(f"Received audio playback request via URL: {msg}")
                     self.pixel_ring.speak()
-                    await self.speaker.play_audio(url, trace_id)
-                    self.pixel_ring.off()
-                    await asyncio.sleep(0.1)
+                    # Don't wait for it, the next sentence's URL should queue up behind it
+                    self.speaker.enqueue(url, trace_id).add_done_callback(self.on_playback_done)
                 else:
-                    logger.info(f"Received message: {msg}")
+                    self.downlink_events.event('message', trace_id=trace_id, detail=msg)
                     self.pixel_ring.off()
+            except websockets.ConnectionClosed as e:
+                self.uplink.connection_lost(ws, e)
             except json.JSONDecodeError as e:
-                pass # Probably some websocket protocol message
+                self.downlink_events.event('non_json') # Probably some websocket protocol message
             except Exception as e:
-                logger.error(f"Error: {e}") # Log in case I'm wrong
+                self.downlink_events.event('error', detail=repr(e)) # Counted in case I'm wrong
                 pass # but probably still some websocket protocol message
 
+    def on_playback_done(self, future):
+        if self.speaker.is_playing:
+            return
+        self.log_spans(spans.finish(self.response_trace))
+        if not self.is_streaming: # Interrupted playback ends while we listen
+            self.pixel_ring.off()
+
+    def log_spans(self, summary):
+        if summary:
+            logger.info(f"Spans: {summary}", extra={"trace_id": summary['trace_id']})
+
     async def run(self):
         try:
+            self.loop = asyncio.get_running_loop()
+            self.watchdog.start()
+            if self.bus:
+                self.bus.start()
             await self.connect_websocket()
             self.open_stream()
             self.stream.start_stream()
-            await asyncio.gather(self.process_audio_queue(), self.listener(self.ws))
+            self.register_metrics()
+            await asyncio.gather(self.process_audio_queue(), self.uplink.run(), self.listener(), self.speaker.serve(),
+                                 self.loop_monitor.run())
 
         finally:
             logger.info("Cleaning up resources...")
+            self.watchdog.stop()
+            if self.bus:
+                self.bus.stop()
             await self.speaker.stop()
             if self.silence_task:
                 self.silence_task.cancel()
             self.stream.stop_stream()
             self.stream.close()
             self.audio.terminate()
-            await self.ws.close()
+            if self.bus:
+                self.capture_ring.close()
+            await self.uplink.close()
+            self.usb.close()
             self.respeaker.close()
-            self.executor.shutdown(wait=False)
 
 async def main():
     audio = AudioController()
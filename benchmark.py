@@ -0,0 +1,439 @@
+"""
+Offline benchmarks for the edge audio path. None of these need the ReSpeaker,
+run e.g. `python benchmark.py codec --wav recording.wav`.
+"""
+import argparse
+import asyncio
+import io
+import threading
+import time
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import config
+
+
+def load_audio(path=None, seconds=30, sample_rate=config.SAMPLE_RATE):
+    """Mono int16 samples from a 16-bit WAV (first channel), or synthetic speech-like noise."""
+    if path:
+        with wave.open(path, 'rb') as wav:
+            data = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+            return data.reshape(-1, wav.getnchannels())[:, 0].copy()
+    rng = np.random.default_rng(0)
+    t = np.arange(seconds * sample_rate) / sample_rate
+    envelope = 0.5 * (1 + np.sin(2 * np.pi * 3 * t)) # Syllable-rate amplitude modulation
+    voiced = np.sin(2 * np.pi * 140 * t) + 0.5 * np.sin(2 * np.pi * 280 * t) + 0.25 * np.sin(2 * np.pi * 420 * t)
+    signal = 4000 * envelope * voiced + 200 * rng.standard_normal(len(t))
+    return signal.clip(-32768, 32767).astype(np.int16)
+
+
+def blocks(samples, size):
+    for i in range(0, len(samples) - size + 1, size):
+        yield samples[i:i + size]
+
+
+def snr_db(reference, decoded):
+    noise = reference.astype(np.float64) - decoded.astype(np.float64)
+    return 10 * np.log10(np.sum(reference.astype(np.float64) ** 2) / max(np.sum(noise ** 2), 1e-9))
+
+
+def bench_codec(args):
+    import codec
+    samples = load_audio(args.wav)
+    seconds = len(samples) / config.SAMPLE_RATE
+    print(f"{seconds:.1f}s of audio in {args.block}-sample blocks")
+    print(f"{'codec':12} {'kbit/s':>8} {'ratio':>6} {'us/block':>9} {'cpu %':>7} {'snr dB':>7}")
+    variants = [(name, cls, True) for name, cls in codec.CODECS.items()]
+    if codec.audioop:
+        # Python 3.13+ has no audioop, IMA-ADPCM then runs the scalar encoder
+        variants.append(('ima_adpcm_py', codec.ImaAdpcmCodec, False))
+    for name, cls, use_audioop in variants:
+        try:
+            enc = cls()
+        except RuntimeError as e:
+            print(f"{name:12} skipped: {e}")
+            continue
+        saved, codec.audioop = codec.audioop, codec.audioop if use_audioop else None
+        encoded = bytearray()
+        start = time.perf_counter()
+        n = 0
+        for block in blocks(samples, args.block):
+            encoded += enc.encode(block)
+            n += 1
+        encoded += enc.flush()
+        elapsed = time.perf_counter() - start
+        codec.audioop = saved
+        raw_bytes = n * args.block * 2
+        snr = f"{snr_db(samples[:n * args.block], cls.decode(bytes(encoded))):7.1f}" if hasattr(cls, 'decode') else f"{'-':>7}"
+        print(f"{name:12} {len(encoded) * 8 / seconds / 1000:8.1f} {raw_bytes / len(encoded):6.2f} "
+              f"{elapsed / n * 1e6:9.1f} {elapsed / seconds * 100:7.3f} {snr}")
+
+
+def wav_bytes(samples, sample_rate=config.SAMPLE_RATE):
+    out = io.BytesIO()
+    with wave.open(out, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(samples.tobytes())
+    return out.getvalue()
+
+
+def trickle_server(payload, bytes_per_second, chunk=1024):
+    """Local HTTP server handing out payload at a fixed rate, like a TTS server still synthesizing."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/x-wav')
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            for i in range(0, len(payload), chunk):
+                self.wfile.write(payload[i:i + chunk])
+                time.sleep(chunk / bytes_per_second)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_playback(args):
+    from speaker_controller import SpeakerController
+    payload = open(args.wav, 'rb').read() if args.wav else wav_bytes(load_audio(seconds=args.seconds))
+    server = trickle_server(payload, args.rate * config.SAMPLE_RATE * 2)
+    print(f"{len(payload)} byte WAV trickled at {args.rate}x real time")
+    print(f"{'mode':24} {'first audio ms':>15} {'total ms':>9}")
+
+    async def run():
+        for label, streaming, buffer_ms in (('playbin defaults', False, 0), *((f'streaming {ms}ms', True, ms) for ms in args.buffer_ms)):
+            speaker = SpeakerController(streaming=streaming, buffer_ms=buffer_ms)
+            # A fresh URL every run, so each one is a cache miss that streams from
+            # the trickle server (playbin's download is teed into the cache meanwhile)
+            url = f"http://127.0.0.1:{server.server_port}/clip-{label.replace(' ', '_')}-{time.time()}.wav"
+            timings = await speaker.play_audio(url)
+            print(f"{label:24} {(timings['first_audio'] or 0) * 1000:15.0f} {timings['total'] * 1000:9.0f}")
+            await speaker.stop()
+
+    asyncio.run(run())
+    server.shutdown()
+
+
+def bench_reconnect(args):
+    import json
+    import websockets
+    from uplink import UplinkSender, Utterance
+    frame_bytes = config.SAMPLE_RATE * config.UPLINK_FRAME_MS // 1000 * 2
+    count = int(args.seconds * 1000 / config.UPLINK_FRAME_MS)
+    sessions = [] # One per connection: {'server', 'start', 'frames', 'stop'}
+
+    async def stt(ws):
+        # Stand-in STT server: records what each connection got, answers STOP like a transcript would
+        session = {'server': len(servers) - 1, 'start': False, 'frames': [], 'stop': False}
+        sessions.append(session)
+        async for message in ws:
+            if isinstance(message, bytes):
+                session['frames'].append(int.from_bytes(message[:4], 'little'))
+            elif json.loads(message)['message'] == 'start':
+                session.update(start=True, frames=[], stop=False)
+            else:
+                session['stop'] = True
+                await ws.send(json.dumps({'text': 'stand-in transcript'}))
+
+    async def listener(uplink, answered):
+        while True:
+            ws = await uplink.wait_connected()
+            try:
+                await ws.recv()
+                uplink.ack()
+                answered.set()
+            except websockets.ConnectionClosed as e:
+                uplink.connection_lost(ws, e)
+
+    async def run():
+        server = await websockets.serve(stt, '127.0.0.1', 0)
+        servers.append(server)
+        port = server.sockets[0].getsockname()[1]
+        uplink = UplinkSender(f'ws://127.0.0.1:{port}')
+        await uplink.connect()
+        answered = asyncio.Event()
+        tasks = [asyncio.create_task(uplink.run()), asyncio.create_task(listener(uplink, answered))]
+        uplink.put_control(json.dumps({'type': 'CONTROL', 'message': 'start'}), Utterance.START)
+        start = time.monotonic()
+        for i in range(count):
+            await asyncio.sleep(max(0.0, start + i * config.UPLINK_FRAME_MS / 1000 - time.monotonic()))
+            uplink.put_audio(i.to_bytes(4, 'little') + bytes(frame_bytes - 4))
+            if i == int(count * args.restart_at):
+                servers[-1].close() # Drops the connection mid-utterance
+                await servers[-1].wait_closed()
+                print(f"STT server stopped after frame {i}, back in {args.downtime}s")
+                await asyncio.sleep(args.downtime)
+                servers.append(await websockets.serve(stt, '127.0.0.1', port))
+        uplink.put_control(json.dumps({'type': 'CONTROL', 'message': 'stop'}), Utterance.STOP)
+        try:
+            await asyncio.wait_for(answered.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            print(f"No answer within {args.timeout}s")
+        for task in tasks:
+            task.cancel()
+        await uplink.close()
+        servers[-1].close()
+        print(uplink.summary())
+
+    servers = []
+    asyncio.run(run())
+    print(f"{'connection':>10} {'server':>7} {'start':>6} {'frames':>7} {'in order':>9} {'stop':>5}")
+    for i, s in enumerate(sessions):
+        print(f"{i:10} {s['server']:7} {s['start']!s:>6} {len(s['frames']):7} {s['frames'] == list(range(len(s['frames'])))!s:>9} {s['stop']!s:>5}")
+    last = sessions[-1] if sessions else None
+    complete = last is not None and last['start'] and last['stop'] and last['frames'] == list(range(count))
+    print(f"{'PASS' if complete else 'FAIL'}: restarted server got START, {len(last['frames']) if last else 0}/{count} frames and STOP")
+    return complete
+
+
+def kws_standin(frame, work, window=np.hanning(512).astype(np.float32)):
+    """CPU-bound stand-in for porcupine.process on a 512-sample frame."""
+    x = frame.astype(np.float32) * window[:len(frame)]
+    for _ in range(work):
+        x = np.abs(np.fft.irfft(np.fft.rfft(x), len(x))).astype(np.float32)
+    return x
+
+
+def consume(ring, captured_at, work, stop):
+    """Read every block off ring like a wake-word consumer would, return latency stats."""
+    from audio_bus import BusReader
+    reader = BusReader(ring, poll_ms=1)
+    latencies = []
+    for seq in reader.blocks(stop):
+        channel = ring.channel(seq, 0)
+        if channel is None:
+            reader.skipped += 1
+            continue
+        for i in range(0, len(channel) - 511, 512):
+            kws_standin(channel[i:i + 512], work)
+        latencies.append(time.monotonic() - captured_at(seq))
+    latencies = np.array(latencies or [0.0])
+    return {'blocks': len(latencies), 'skipped': reader.skipped,
+            'mean_ms': latencies.mean() * 1000, 'p95_ms': np.percentile(latencies, 95) * 1000}
+
+
+def bus_consumer(spec, work, results, stop):
+    from audio_bus import SharedCaptureRing
+    ring = SharedCaptureRing.attach(spec)
+    results.put(consume(ring, ring.captured_at, work, stop))
+
+
+def bench_bus(args):
+    from audio_buffer import CaptureRing
+    from audio_bus import SharedCaptureRing, BusSupervisor
+    rng = np.random.default_rng(0)
+    data = rng.integers(-3000, 3000, size=(args.block, config.CHANNELS), dtype=np.int16).tobytes()
+    period = args.block / config.SAMPLE_RATE / args.speed
+    print(f"{args.consumers} consumers, {args.block}-frame blocks every {period * 1000:.1f}ms for {args.seconds}s")
+    print(f"{'mode':14} {'consumer':>8} {'blocks':>7} {'skipped':>8} {'mean ms':>8} {'p95 ms':>8}")
+
+    def produce(ring, stamps):
+        start = time.monotonic()
+        n = 0
+        while time.monotonic() - start < args.seconds:
+            seq = ring.write(data)
+            stamps[seq % len(stamps)] = time.monotonic()
+            n += 1
+            time.sleep(max(0.0, start + n * period - time.monotonic()))
+
+    # Everything in one interpreter, consumers as threads sharing the GIL like AudioController does
+    ring = CaptureRing(CaptureRing.slots_for(config.CAPTURE_RING_MS, args.block, config.SAMPLE_RATE), args.block, config.CHANNELS)
+    stamps = np.zeros(ring.slots)
+    stop = threading.Event()
+    results = [None] * args.consumers
+    def run(i):
+        results[i] = consume(ring, lambda seq: stamps[seq % ring.slots], args.work, stop)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(args.consumers)]
+    for thread in threads:
+        thread.start()
+    produce(ring, stamps)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    for i, r in enumerate(results):
+        print(f"{'single process':14} {i:8} {r['blocks']:7} {r['skipped']:8} {r['mean_ms']:8.1f} {r['p95_ms']:8.1f}")
+
+    # The same consumers as audio bus workers in their own processes
+    ring = SharedCaptureRing(f"{config.AUDIO_BUS_NAME}_bench", CaptureRing.slots_for(config.CAPTURE_RING_MS, args.block, config.SAMPLE_RATE), args.block, config.CHANNELS, create=True)
+    collected = []
+    bus = BusSupervisor(ring, collected.append)
+    for i in range(args.consumers):
+        bus.add(f'consumer{i}', bus_consumer, args.work)
+    bus.start()
+    time.sleep(args.startup) # Spawned interpreters need a moment to import numpy
+    produce(ring, ring.stamps)
+    bus.running = False # Finished workers aren't crashes
+    bus.stop_event.set()
+    while len(collected) < args.consumers:
+        collected.append(bus.results.get(timeout=10))
+    bus.stop()
+    ring.close()
+    for i, r in enumerate(collected):
+        print(f"{'audio bus':14} {i:8} {r['blocks']:7} {r['skipped']:8} {r['mean_ms']:8.1f} {r['p95_ms']:8.1f}")
+
+
+def household_audio(seconds, sample_rate=config.SAMPLE_RATE, speech_fraction=0.2):
+    """Room noise with speech-like bursts covering about speech_fraction of the time."""
+    rng = np.random.default_rng(1)
+    noise = 30 * rng.standard_normal(seconds * sample_rate)
+    speech = load_audio(seconds=seconds, sample_rate=sample_rate).astype(np.float64)
+    active = np.zeros(seconds * sample_rate)
+    for start in rng.choice(seconds, size=max(1, int(seconds * speech_fraction / 2)), replace=False):
+        active[start * sample_rate:(start + 2) * sample_rate] = 1
+    return (noise + speech * active[:len(speech)]).clip(-32768, 32767).astype(np.int16)
+
+
+def bench_gate(args):
+    from vad import WakeGate
+    porcupine = None
+    try:
+        import pvporcupine
+        porcupine = pvporcupine.create(access_key=config.ACCESS_KEY, keyword_paths=config.KEYWORD_PATHS)
+    except Exception as e:
+        print(f"porcupine unavailable ({e}), assuming {args.engine_ms}ms per frame and no detections")
+    frame_length = porcupine.frame_length if porcupine else 512
+    rng = np.random.default_rng(2)
+    corpora = {'idle': (8 * rng.standard_normal(args.seconds * config.SAMPLE_RATE)).astype(np.int16),
+               'household': household_audio(args.seconds)}
+    for path in args.wav:
+        corpora[path] = load_audio(path)
+    print(f"{'corpus':24} {'frames':>7} {'passed %':>9} {'gate us':>8} {'engine ms':>10} {'cpu saved %':>12} "
+          f"{'wakes':>6} {'gated':>6} {'missed':>7}")
+    total_wakes = 0
+    for name, samples in corpora.items():
+        count = len(samples) // frame_length
+        frames = samples[:count * frame_length].reshape(count, frame_length)
+        gate = WakeGate(frame_length)
+        start = time.perf_counter()
+        passed = [gate.process(block) for block in np.array_split(frames, max(1, count // 8))] # 4096-sample blocks
+        gate_s = time.perf_counter() - start
+        wakes = gated_wakes = 0
+        engine_s = args.engine_ms / 1000 * count
+        if porcupine:
+            start = time.perf_counter()
+            wakes = sum(porcupine.process(frame) >= 0 for frame in frames)
+            engine_s = time.perf_counter() - start
+            porcupine.delete() # Fresh state for the gated run
+            porcupine = pvporcupine.create(access_key=config.ACCESS_KEY, keyword_paths=config.KEYWORD_PATHS)
+            gated_wakes = sum(porcupine.process(frame) >= 0 for block in passed for _, frame in block)
+        saved = 1 - (gate_s + engine_s * gate.pass_ratio) / engine_s
+        total_wakes += wakes
+        missed = f"{max(0, wakes - gated_wakes):7}" if porcupine else f"{'-':>7}"
+        print(f"{name[-24:]:24} {count:7} {gate.pass_ratio * 100:9.1f} {gate_s / count * 1e6:8.1f} "
+              f"{engine_s / count * 1000:10.3f} {saved * 100:12.1f} {wakes:6} {gated_wakes:6} {missed}")
+    if not total_wakes:
+        # The synthetic corpora hold no wake words, so only the CPU side is measured
+        print("Miss rate NOT measured: no wake word was detected without the gate. "
+              "Pass --wav recordings containing the wake word, with porcupine installed.")
+
+
+def bench_framing(args):
+    from audio_buffer import FrameAccumulator
+    samples = load_audio(seconds=2 * args.seconds)
+    uplink_frame = config.SAMPLE_RATE * config.UPLINK_FRAME_MS // 1000
+    print(f"{args.seconds}s listening for the wake word ({args.work} FFT round trips per 512-sample frame), "
+          f"then {args.seconds}s streaming in {config.UPLINK_FRAME_MS}ms uplink frames")
+    print("wake to stream: from the last sample of a wake word ending on any frame to starting the stream")
+    print("end to end: from capturing the newest sample of an uplink frame to handing it to the uplink")
+    print(f"{'frames/buffer':>13} {'callbacks/s':>12} {'wake->stream mean':>18} {'max ms':>7} "
+          f"{'end-to-end mean':>16} {'max ms':>7} {'cpu %':>6}")
+
+    async def run(frames_per_buffer):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        period = frames_per_buffer / config.SAMPLE_RATE
+        start = time.monotonic() + 0.1
+        captured = lambda position: start + position / config.SAMPLE_RATE
+
+        def capture():
+            # Like the PortAudio callback: a buffer is handed over once its last sample is in
+            for n, i in enumerate(range(0, len(samples) - frames_per_buffer + 1, frames_per_buffer), 1):
+                time.sleep(max(0.0, start + n * period - time.monotonic()))
+                loop.call_soon_threadsafe(queue.put_nowait, (i, samples[i:i + frames_per_buffer]))
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+        wake_frames = FrameAccumulator(512)
+        uplink_frames = FrameAccumulator(uplink_frame)
+        wake, uplink = [], []
+        position = 0
+        cpu = time.process_time()
+        threading.Thread(target=capture, daemon=True).start()
+        while (item := await queue.get()) is not None:
+            offset, block = item
+            if offset < len(samples) // 2:
+                end = offset - wake_frames.fill
+                for frame in wake_frames.push(block):
+                    end += 512
+                    kws_standin(frame, args.work)
+                    # A detection here would start the stream right away, pre-roll and remainder included
+                    wake.append(time.monotonic() - captured(end))
+                position = offset + len(block)
+            else:
+                for frame in uplink_frames.push(block):
+                    position += len(frame)
+                    uplink.append(time.monotonic() - captured(position))
+        cpu = (time.process_time() - cpu) / (len(samples) / config.SAMPLE_RATE)
+        wake, uplink = np.array(wake or [0.0]), np.array(uplink or [0.0])
+        print(f"{frames_per_buffer:13} {config.SAMPLE_RATE / frames_per_buffer:12.1f} {wake.mean() * 1000:18.1f} {wake.max() * 1000:7.1f} "
+              f"{uplink.mean() * 1000:16.1f} {uplink.max() * 1000:7.1f} {cpu * 100:6.1f}")
+
+    for frames_per_buffer in args.sizes:
+        asyncio.run(run(frames_per_buffer))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('codec', help='Uplink codec bandwidth and CPU against raw PCM')
+    p.add_argument('--wav', help='16-bit WAV to encode instead of synthetic audio')
+    p.add_argument('--block', type=int, default=4096, help='Samples per encode call')
+    p.set_defaults(func=bench_codec)
+
+    p = sub.add_parser('playback', help='Time to first audio for a WAV trickled from a local HTTP server')
+    p.add_argument('--wav', help='WAV to serve instead of synthetic audio')
+    p.add_argument('--seconds', type=int, default=10, help='Length of the synthetic clip')
+    p.add_argument('--rate', type=float, default=1.5, help='Trickle rate as a multiple of real time')
+    p.add_argument('--buffer-ms', type=int, nargs='+', default=[100, 200, 500], help='Streaming buffer sizes to try')
+    p.set_defaults(func=bench_playback)
+
+    p = sub.add_parser('reconnect', help='Restart a stand-in STT server mid-utterance and check the utterance is replayed')
+    p.add_argument('--seconds', type=float, default=3, help='Length of the utterance')
+    p.add_argument('--restart-at', type=float, default=0.4, help='Fraction of the utterance sent when the server goes down')
+    p.add_argument('--downtime', type=float, default=1.0, help='Seconds the server stays down')
+    p.add_argument('--timeout', type=float, default=60, help='Seconds to wait for the answer to STOP')
+    p.set_defaults(func=bench_reconnect)
+
+    p = sub.add_parser('bus',help='Consumer latency with threads in one process against audio bus worker processes')
+    p.add_argument('--consumers', type=int, default=3, help='Wake-word-like consumers reading every block')
+    p.add_argument('--work', type=int, default=20, help='FFT round trips per 512-sample frame, the consumer load')
+    p.add_argument('--block', type=int, default=4096, help='Frames per capture block')
+    p.add_argument('--speed', type=float, default=1.0, help='Capture rate as a multiple of real time')
+    p.add_argument('--seconds', type=float, default=10, help='How long to capture')
+    p.add_argument('--startup', type=float, default=3, help='Seconds to let the worker processes start')
+    p.set_defaults(func=bench_bus)
+
+    p = sub.add_parser('gate', help='Share of frames the wake gate passes to porcupine, CPU saved and detections kept')
+    p.add_argument('--wav', nargs='*', default=[], help='Recordings to add to the synthetic idle and household corpora')
+    p.add_argument('--seconds', type=int, default=60, help='Length of the synthetic corpora')
+    p.add_argument('--engine-ms', type=float, default=2.0, help='Porcupine time per frame to assume when it is not installed')
+    p.set_defaults(func=bench_gate)
+
+    p = sub.add_parser('framing', help='Wake detection and uplink latency for each capture buffer size')
+    p.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1000, 1024, 2048, 4096], help='Frames per buffer to try')
+    p.add_argument('--seconds', type=int, default=4, help='Audio to stream per buffer size')
+    p.add_argument('--work', type=int, default=10, help='FFT round trips per 512-sample frame, standing in for porcupine')
+    p.set_defaults(func=bench_framing)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
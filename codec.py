@@ -0,0 +1,250 @@
+import struct
+import numpy as np
+import config
+
+try:
+    import audioop # Deprecated in 3.11, removed in 3.13; only used to speed up IMA-ADPCM
+except ImportError:
+    audioop = None
+
+
+class PcmCodec:
+    """Raw 16-bit little-endian PCM, what the STT server has always received."""
+    name = 'pcm_s16le'
+    bits_per_sample = 16
+
+    def __init__(self, sample_rate=config.SAMPLE_RATE):
+        self.sample_rate = sample_rate
+
+    def describe(self):
+        """Stream description announced in the START control message."""
+        return {"codec": self.name, "sample_rate": self.sample_rate, "channels": 1}
+
+    def reset(self):
+        pass
+
+    def encode(self, samples):
+        return memoryview(np.ascontiguousarray(samples, dtype=np.int16)).cast('B')
+
+    def flush(self):
+        return b''
+
+
+# G.711 tables, see ITU-T G.711 and the Sun reference g711.c
+_ULAW_BIAS = 0x84
+_ULAW_SEG_END = np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF], dtype=np.int32)
+_ALAW_SEG_END = np.array([0x1F, 0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF], dtype=np.int32)
+
+
+def lin2ulaw(samples):
+    x = np.asarray(samples, dtype=np.int32) >> 2 # 14-bit input
+    mask = np.where(x < 0, 0x7F, 0xFF)
+    x = np.minimum(np.abs(x), 8159) + (_ULAW_BIAS >> 2)
+    seg = np.searchsorted(_ULAW_SEG_END, x)
+    uval = (np.minimum(seg, 7) << 4) | ((x >> (np.minimum(seg, 7) + 1)) & 0x0F)
+    uval = np.where(seg >= 8, 0x7F, uval)
+    return ((uval ^ mask) & 0xFF).astype(np.uint8)
+
+
+def lin2alaw(samples):
+    x = np.asarray(samples, dtype=np.int32) >> 3
+    mask = np.where(x >= 0, 0xD5, 0x55)
+    x = np.where(x >= 0, x, -x - 1)
+    seg = np.searchsorted(_ALAW_SEG_END, x)
+    shift = np.where(seg < 2, 1, seg)
+    aval = (np.minimum(seg, 7) << 4) | ((x >> np.minimum(shift, 7)) & 0x0F)
+    aval = np.where(seg >= 8, 0x7F, aval)
+    return ((aval ^ mask) & 0xFF).astype(np.uint8)
+
+
+def _ulaw_table():
+    u = ~np.arange(256, dtype=np.int32) & 0xFF
+    t = (((u & 0x0F) << 3) + _ULAW_BIAS) << ((u & 0x70) >> 4)
+    return np.where(u & 0x80, _ULAW_BIAS - t, t - _ULAW_BIAS).astype(np.int16)
+
+
+def _alaw_table():
+    a = np.arange(256, dtype=np.int32) ^ 0x55
+    seg = (a & 0x70) >> 4
+    t = (a & 0x0F) << 4
+    t = np.where(seg == 0, t + 8, np.where(seg == 1, t + 0x108, (t + 0x108) << np.maximum(seg - 1, 0)))
+    return np.where(a & 0x80, t, -t).astype(np.int16)
+
+
+ULAW_TO_LINEAR = _ulaw_table()
+ALAW_TO_LINEAR = _alaw_table()
+
+
+def ulaw2lin(data):
+    return ULAW_TO_LINEAR[np.frombuffer(data, dtype=np.uint8)]
+
+
+def alaw2lin(data):
+    return ALAW_TO_LINEAR[np.frombuffer(data, dtype=np.uint8)]
+
+
+class MuLawCodec(PcmCodec):
+    """G.711 mu-law, 8 bits per sample."""
+    name = 'mulaw'
+    bits_per_sample = 8
+
+    def encode(self, samples):
+        return lin2ulaw(samples).tobytes()
+
+    @staticmethod
+    def decode(data):
+        return ulaw2lin(data)
+
+
+class ALawCodec(PcmCodec):
+    """G.711 A-law, 8 bits per sample."""
+    name = 'alaw'
+    bits_per_sample = 8
+
+    def encode(self, samples):
+        return lin2alaw(samples).tobytes()
+
+    @staticmethod
+    def decode(data):
+        return alaw2lin(data)
+
+
+_IMA_INDEX_TABLE = (-1, -1, -1, -1, 2, 4, 6, 8, -1, -1, -1, -1, 2, 4, 6, 8)
+_IMA_STEP_TABLE = (
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+    50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230,
+    253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+    1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327,
+    3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442,
+    11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794,
+    32767)
+
+
+def _lin2adpcm(samples, state):
+    """Scalar IMA-ADPCM encoder, bit-exact with audioop.lin2adpcm for even-length input (first sample in the high nibble)."""
+    valpred, index = state if state else (0, 0)
+    step = _IMA_STEP_TABLE[index]
+    out = bytearray((len(samples) + 1) // 2)
+    for n, val in enumerate(samples.tolist()):
+        diff = val - valpred
+        sign = 8 if diff < 0 else 0
+        if sign:
+            diff = -diff
+        delta = 0
+        vpdiff = step >> 3
+        if diff >= step:
+            delta = 4
+            diff -= step
+            vpdiff += step
+        step >>= 1
+        if diff >= step:
+            delta |= 2
+            diff -= step
+            vpdiff += step
+        step >>= 1
+        if diff >= step:
+            delta |= 1
+            vpdiff += step
+        valpred = valpred - vpdiff if sign else valpred + vpdiff
+        valpred = max(-32768, min(32767, valpred))
+        delta |= sign
+        index = max(0, min(88, index + _IMA_INDEX_TABLE[delta]))
+        step = _IMA_STEP_TABLE[index]
+        if n & 1:
+            out[n >> 1] |= delta
+        else:
+            out[n >> 1] = delta << 4
+    return bytes(out), (valpred, index)
+
+
+class ImaAdpcmCodec(PcmCodec):
+    """
+    IMA-ADPCM, 4 bits per sample.
+
+    Each encoded frame starts with a '<hBBH' header (predictor, step index, 0,
+    sample count) holding the encoder state before the frame, so frames decode
+    independently and can be concatenated or dropped without desyncing the server.
+    Odd-length input gets its last sample repeated, so every frame is whole bytes
+    and the count in the header is what was encoded.
+    """
+    name = 'ima_adpcm'
+    bits_per_sample = 4
+    HEADER = struct.Struct('<hBBH')
+
+    def __init__(self, sample_rate=config.SAMPLE_RATE):
+        super().__init__(sample_rate)
+        self.state = None
+
+    def describe(self):
+        return dict(super().describe(), nibble_order="high_first", frame_header="<hBBH")
+
+    def reset(self):
+        self.state = None
+
+    def encode(self, samples):
+        samples = np.ascontiguousarray(samples, dtype=np.int16)
+        if len(samples) & 1:
+            samples = np.append(samples, samples[-1])
+        valpred, index = self.state if self.state else (0, 0)
+        header = self.HEADER.pack(valpred, index, 0, len(samples))
+        if audioop:
+            data, self.state = audioop.lin2adpcm(samples.tobytes(), 2, self.state)
+        else:
+            data, self.state = _lin2adpcm(samples, self.state)
+        return header + data
+
+
+class OpusCodec(PcmCodec):
+    """
+    Opus via the optional opuslib package.
+
+    Input is cut into fixed OPUS_FRAME_MS packets, leftovers carry over to the
+    next call. Each packet is prefixed with its length as '<H'.
+    """
+    name = 'opus'
+    bits_per_sample = None
+
+    def __init__(self, sample_rate=config.SAMPLE_RATE):
+        super().__init__(sample_rate)
+        try:
+            import opuslib
+        except ImportError:
+            raise RuntimeError("UPLINK_CODEC 'opus' requires the opuslib package (and libopus)")
+        self.opuslib = opuslib
+        self.frame_size = sample_rate * config.OPUS_FRAME_MS // 1000
+        self.pending = np.zeros(0, dtype=np.int16)
+        self.encoder = None
+        self.reset()
+
+    def describe(self):
+        return dict(super().describe(), frame_ms=config.OPUS_FRAME_MS, bitrate=config.OPUS_BITRATE, packet_prefix="<H")
+
+    def reset(self):
+        self.encoder = self.opuslib.Encoder(self.sample_rate, 1, self.opuslib.APPLICATION_VOIP)
+        self.encoder.bitrate = config.OPUS_BITRATE
+        self.pending = np.zeros(0, dtype=np.int16)
+
+    def encode(self, samples):
+        samples = np.concatenate((self.pending, np.asarray(samples, dtype=np.int16)))
+        usable = len(samples) - len(samples) % self.frame_size
+        out = bytearray()
+        for i in range(0, usable, self.frame_size):
+            packet = self.encoder.encode(samples[i:i + self.frame_size].tobytes(), self.frame_size)
+            out += struct.pack('<H', len(packet)) + packet
+        self.pending = samples[usable:]
+        return bytes(out)
+
+    def flush(self):
+        if not len(self.pending):
+            return b''
+        return self.encode(np.zeros(self.frame_size - len(self.pending), dtype=np.int16))
+
+
+CODECS = {codec.name: codec for codec in (PcmCodec, MuLawCodec, ALawCodec, ImaAdpcmCodec, OpusCodec)}
+
+
+def create_codec(name):
+    try:
+        return CODECS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown uplink codec '{name}', expected one of {', '.join(CODECS)}")
@@ -0,0 +1,111 @@
+import threading
+import time
+import wave
+from pathlib import Path
+import numpy as np
+import config
+from metrics import LatencyStats
+
+logger = config.get_logger('rpi')
+
+NAMES = ('wake', 'stop', 'error')
+
+
+def tone(freqs, ms, sample_rate, level=0.3):
+    """Short sine tones back to back with a raised-cosine fade, the built-in earcons."""
+    n = sample_rate * ms // 1000
+    t = np.arange(n) / sample_rate
+    fade = np.minimum(1, np.minimum(np.arange(n), np.arange(n)[::-1]) / (sample_rate * 0.005))
+    fade = 0.5 - 0.5 * np.cos(np.pi * fade)
+    parts = [level * 32767 * fade * np.sin(2 * np.pi * f * t) if f else np.zeros(n) for f in freqs]
+    return np.concatenate(parts).astype(np.int16)
+
+
+class Earcons:
+    """
+    Short acknowledgement sounds decoded into memory once at startup.
+
+    EARCON_DIR/<name>.wav is used when present (16-bit, first channel, resampled
+    to sample_rate), otherwise a built-in tone. Earcons is a PcmOutput source that
+    never drains: it plays silence until play() swaps in a clip, so the audio
+    sink stays open and a tone starts with the next frame pulled. play() only
+    swaps a reference and never blocks the caller. The time from play() to the
+    clip's first buffer reaching the audio sink (see at_sink()) is logged as
+    wake-to-tone latency.
+    """
+    drained = False
+
+    def __init__(self, directory=config.EARCON_DIR, sample_rate=config.SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        builtin = {
+            'wake': tone((880, 1320), 60, sample_rate),
+            'stop': tone((1320, 880), 60, sample_rate),
+            'error': tone((330, 0, 330), 80, sample_rate),
+        }
+        self.clips = {}
+        for name in NAMES:
+            path = Path(directory) / f'{name}.wav'
+            try:
+                self.clips[name] = self.load(path) if path.exists() else builtin[name]
+            except Exception as e:
+                logger.warning(f"Using built-in {name} earcon, can't read {path}: {e}")
+                self.clips[name] = builtin[name]
+        self.lock = threading.Lock()
+        self.clip = None
+        self.pos = 0
+        self.pending = None # (name, trace_id, requested_at) until the first frame of the clip is pulled
+        self.position = 0 # Samples pulled so far, the stream time of the next frame
+        self.reaching = None # Pending plus the clip's stream time in ns, until it reaches the sink
+        self.latency = LatencyStats('wake_to_tone')
+
+    def load(self, path):
+        with wave.open(str(path), 'rb') as wav:
+            if wav.getsampwidth() != 2:
+                raise ValueError("not 16-bit PCM")
+            data = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+            data = data.reshape(-1, wav.getnchannels())[:, 0]
+            rate = wav.getframerate()
+        if rate != self.sample_rate:
+            positions = np.arange(len(data) * self.sample_rate // rate) * rate / self.sample_rate
+            data = np.interp(positions, np.arange(len(data)), data).astype(np.int16)
+        return data.copy()
+
+    def play(self, name, trace_id=None):
+        with self.lock:
+            self.clip = self.clips[name]
+            self.pos = 0
+            self.pending = (name, trace_id, time.monotonic())
+
+    def pull(self, n, out):
+        # Runs on the appsrc streaming thread
+        with self.lock:
+            clip, pos, pending = self.clip, self.pos, self.pending
+            self.pending = None
+            if pending:
+                self.reaching = (*pending, self.position * 1_000_000_000 // self.sample_rate)
+            self.position += n
+            if clip is not None:
+                self.pos += n
+                if self.pos >= len(clip):
+                    self.clip = None
+        if clip is None:
+            out[:n] = 0
+            return out
+        take = min(n, len(clip) - pos)
+        out[:take] = clip[pos:pos + take]
+        out[take:n] = 0
+        return out
+
+    def at_sink(self, end_ns):
+        # Runs on the streaming thread for every buffer reaching the sink, end_ns is its stream time end
+        if self.reaching is None or end_ns <= self.reaching[3]:
+            return
+        with self.lock:
+            reaching, self.reaching = self.reaching, None
+        if reaching:
+            name, trace_id, requested_at, _ = reaching
+            self.latency.observe(time.monotonic() - requested_at)
+            logger.info(f"Earcon {name}: {self.latency.last * 1000:.1f}ms to the audio sink", extra={"trace_id": trace_id})
+
+    def stats(self):
+        return {'wake_to_tone': self.latency.summary()}
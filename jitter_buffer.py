@@ -0,0 +1,117 @@
+import threading
+import time
+import numpy as np
+import config
+
+
+class JitterBuffer:
+    """
+    Adaptive jitter buffer between pushed PCM frames and a pulling audio sink.
+
+    push() is called as frames arrive from the network, pull() by the playback
+    thread at the sink's pace. Playback only starts (and restarts after an
+    underrun) once the buffer holds target_ms. The target follows the measured
+    inter-arrival jitter between min_ms and max_ms and is raised after every
+    underrun. When the buffer would exceed max_ms, the oldest audio is dropped
+    down to the target (an overrun).
+    """
+
+    def __init__(self, sample_rate=config.SAMPLE_RATE, min_ms=config.JITTER_MIN_MS,
+                 target_ms=config.JITTER_TARGET_MS, max_ms=config.JITTER_MAX_MS):
+        self.sample_rate = sample_rate
+        self.min_samples = sample_rate * min_ms // 1000
+        self.max_samples = sample_rate * max_ms // 1000
+        self.target = sample_rate * target_ms // 1000
+        self.boost = 0.0 # Extra headroom after underruns, decays away as frames keep arriving
+        self.buffer = np.zeros(self.max_samples, dtype=np.int16)
+        self.read_pos = 0
+        self.depth = 0
+        self.lock = threading.Lock()
+        self.playing = False # False while (re)filling up to the target
+        self.ended = False
+        self.jitter = self.target / 3 # Smoothed inter-arrival jitter in samples, RFC 3550 style
+        self.last_arrival = None
+        self.last_frame = 0
+        self.underruns = 0
+        self.overruns = 0
+        self.received = 0
+        self.played = 0
+
+    @property
+    def target_ms(self):
+        return self.target * 1000 // self.sample_rate
+
+    def push(self, samples):
+        now = time.monotonic()
+        n = len(samples)
+        with self.lock:
+            self.received += n
+            if self.last_arrival is not None:
+                # How far this frame arrived from when the previous frame's length predicted
+                deviation = abs((now - self.last_arrival) * self.sample_rate - self.last_frame)
+                self.jitter += (deviation - self.jitter) / 16
+                self.boost *= 0.98
+                self.target = int(min(self.max_samples // 2, max(self.min_samples, 3 * self.jitter + self.boost)))
+            self.last_arrival = now
+            self.last_frame = n
+            if n >= self.max_samples:
+                samples = samples[n - self.max_samples:]
+                n = len(samples)
+                self.overruns += 1
+            if self.depth + n > self.max_samples:
+                drop = self.depth + n - max(self.target, n)
+                drop = min(drop, self.depth)
+                self.read_pos = (self.read_pos + drop) % self.max_samples
+                self.depth -= drop
+                self.overruns += 1
+            write_pos = (self.read_pos + self.depth) % self.max_samples
+            first = min(n, self.max_samples - write_pos)
+            self.buffer[write_pos:write_pos + first] = samples[:first]
+            self.buffer[:n - first] = samples[first:]
+            self.depth += n
+
+    def end(self):
+        """No more frames are coming, play out whatever is left without waiting for the target."""
+        with self.lock:
+            self.ended = True
+
+    def clear(self):
+        """Drop everything buffered and end, e.g. when playback is interrupted."""
+        with self.lock:
+            self.depth = 0
+            self.ended = True
+
+    def pull(self, n, out=None):
+        """n samples for the sink, silence where there's nothing (yet) to play."""
+        if out is None:
+            out = np.zeros(n, dtype=np.int16)
+        with self.lock:
+            if not self.playing and (self.depth >= self.target or (self.ended and self.depth)):
+                self.playing = True
+            if not self.playing:
+                out[:n] = 0
+                return out
+            take = min(n, self.depth)
+            first = min(take, self.max_samples - self.read_pos)
+            out[:first] = self.buffer[self.read_pos:self.read_pos + first]
+            out[first:take] = self.buffer[:take - first]
+            out[take:n] = 0
+            self.read_pos = (self.read_pos + take) % self.max_samples
+            self.depth -= take
+            self.played += take
+            if take < n and not self.ended:
+                self.underruns += 1
+                self.playing = False
+                # Ask for more headroom next time
+                self.boost += self.sample_rate * 20 // 1000
+                self.target = int(min(self.max_samples // 2, self.target + self.sample_rate * 20 // 1000))
+        return out
+
+    @property
+    def drained(self):
+        return self.ended and self.depth == 0
+
+    def stats(self):
+        return {'underruns': self.underruns, 'overruns': self.overruns, 'target_ms': self.target_ms,
+                'jitter_ms': round(self.jitter * 1000 / self.sample_rate, 2),
+                'received_ms': self.received * 1000 // self.sample_rate, 'played_ms': self.played * 1000 // self.sample_rate}
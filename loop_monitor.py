@@ -0,0 +1,106 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+import config
+from metrics import LatencyStats, Histogram
+from trace_id import trace_id
+
+logger = config.get_logger('rpi')
+
+
+class LoopLagMonitor:
+    """
+    Samples event loop lag: how much later than asked a sleep of `interval`
+    wakes up. Anything holding the loop (a blocking call, a long callback)
+    shows up as lag. Lag above `warn_after` is logged.
+    """
+
+    def __init__(self, interval=config.LOOP_LAG_INTERVAL_S, warn_after=config.LOOP_LAG_WARN_S):
+        self.interval = interval
+        self.warn_after = warn_after
+        self.lag = LatencyStats('loop_lag')
+        self.histogram = Histogram('loop_lag')
+        self.heartbeat = time.monotonic() # Last time the loop got to run us
+        self.ticks = 0
+
+    async def run(self):
+        while True:
+            start = self.heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.heartbeat = time.monotonic()
+            self.ticks += 1
+            lag = max(0.0, self.heartbeat - start - self.interval)
+            self.lag.observe(lag)
+            self.histogram.observe(lag)
+            if lag > self.warn_after:
+                logger.warning(f"Event loop lagged {lag * 1000:.0f}ms ({self.lag.summary()})")
+
+
+class LoopWatchdog:
+    """
+    Catches the event loop in the act of being blocked.
+
+    A thread checks the LoopLagMonitor heartbeat every threshold/2, once the
+    monitor has ticked at least once (startup before that isn't watched). When
+    the loop hasn't ticked for `threshold` past its interval, the loop thread's
+    stack, the task running and its trace ID are logged once per stall; how long
+    the stall lasted is logged and counted when the loop comes back. Costs one
+    sleeping thread and a few attribute reads per check.
+    """
+
+    def __init__(self, monitor, threshold=config.LOOP_BLOCKED_WARN_S):
+        self.monitor = monitor
+        self.threshold = threshold
+        self.loop = None
+        self.loop_thread = None
+        self.stalled = False
+        self.stalled_since = 0.0 # When the loop should have ticked, for the stall being reported
+        self.stalls = 0
+        self.blocked = LatencyStats('loop_blocked')
+        self.running = False
+        self.thread = threading.Thread(target=self.watch, name='loop-watchdog', daemon=True)
+
+    def start(self):
+        """Call from the event loop thread."""
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.running = True
+        self.thread.start()
+
+    def watch(self):
+        while self.running:
+            time.sleep(self.threshold / 2)
+            if not self.monitor.ticks:
+                continue
+            heartbeat = self.monitor.heartbeat
+            behind = time.monotonic() - heartbeat - self.monitor.interval
+            if behind > self.threshold and not self.stalled:
+                self.stalled = True
+                self.stalled_since = heartbeat + self.monitor.interval
+                self.stalls += 1
+                self.report(behind)
+            elif behind <= self.threshold and self.stalled:
+                self.stalled = False
+                # The heartbeat moved when the loop got back to the monitor
+                blocked = max(0.0, heartbeat - self.stalled_since)
+                self.blocked.observe(blocked)
+                logger.warning(f"Event loop unblocked after {blocked * 1000:.0f}ms "
+                               f"({self.stalls} stalls, {self.blocked.summary()})")
+
+    def report(self, behind):
+        frame = sys._current_frames().get(self.loop_thread)
+        stack = ''.join(traceback.format_stack(frame, limit=12)) if frame else '(no frame)\n'
+        task = asyncio.current_task(self.loop)
+        trace = None
+        if task is not None:
+            context = task.get_context() if hasattr(task, 'get_context') else getattr(task, '_context', None)
+            trace = context.get(trace_id) if context is not None else None
+            where = f"task {task.get_name()} ({task.get_coro().__qualname__})"
+        else:
+            where = "a callback outside any task"
+        logger.warning(f"Event loop blocked for {behind * 1000:.0f}ms in {where}:\n{stack}", extra={"trace_id": trace})
+
+    def stop(self):
+        self.running = False
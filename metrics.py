@@ -0,0 +1,159 @@
+import bisect
+import threading
+
+
+class LatencyStats:
+    """Running count/sum/max of an observed duration, in seconds."""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+            self.last = 0.0
+
+    def observe(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            self.last = seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        return (f"{self.name}: n={self.count} mean={self.mean * 1000:.2f}ms "
+                f"max={self.max * 1000:.2f}ms last={self.last * 1000:.2f}ms")
+
+
+class EventCounter:
+    """
+    Counts high-frequency events (per audio chunk, per message) instead of
+    logging each one. Counts and byte totals per kind are logged once by
+    flush(), e.g. at the end of an utterance. With sample_every=N the first and
+    then every Nth event of a kind is still logged at DEBUG, with its trace id.
+    """
+
+    def __init__(self, logger, name, sample_every=0):
+        self.logger = logger
+        self.name = name
+        self.sample_every = sample_every
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.bytes = {}
+        self.trace_id = None
+
+    def event(self, kind, size=0, trace_id=None, detail=None):
+        with self.lock:
+            n = self.counts[kind] = self.counts.get(kind, 0) + 1
+            self.bytes[kind] = self.bytes.get(kind, 0) + size
+            if trace_id:
+                self.trace_id = trace_id
+        if self.sample_every and (n - 1) % self.sample_every == 0: # The 1st, N+1th, ...
+            self.logger.debug(f"{self.name} {kind} #{n}: {detail if detail is not None else f'{size} bytes'}",
+                              extra={"trace_id": trace_id})
+
+    def flush(self, trace_id=None):
+        """Log and reset the counts, if there were any."""
+        with self.lock:
+            counts, sizes, last_trace = self.counts, self.bytes, self.trace_id
+            self.counts, self.bytes, self.trace_id = {}, {}, None
+        if counts:
+            summary = ", ".join(f"{kind}={n}" + (f" ({sizes[kind]} bytes)" if sizes[kind] else "") for kind, n in counts.items())
+            self.logger.info(f"{self.name}: {summary}", extra={"trace_id": trace_id or last_trace})
+
+
+class Histogram:
+    """Cumulative bucket counts of an observed duration, in seconds, Prometheus style."""
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, name, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.buckets) + 1) # Last one is +Inf
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.total += seconds
+
+
+class Registry:
+    """
+    Metrics exposed in the Prometheus text format. Values are read when rendered,
+    through callables or the LatencyStats/Histogram objects the code already
+    keeps, so nothing on the hot path changes to be exported.
+    """
+
+    def __init__(self, prefix='havencore_edge_'):
+        self.prefix = prefix
+        self.metrics = {} # name: [type, help, [(labels, source)]]
+
+    def add(self, kind, name, help, source, /, **labels):
+        entry = self.metrics.setdefault(self.prefix + name, [kind, help, []])
+        entry[2] = [(l, s) for l, s in entry[2] if l != labels] + [(labels, source)] # Re-registering replaces
+        return source
+
+    def counter(self, name, help, fn, /, **labels):
+        return self.add('counter', name, help, fn, **labels)
+
+    def gauge(self, name, help, fn, /, **labels):
+        return self.add('gauge', name, help, fn, **labels)
+
+    def latency(self, name, help, stats, /, **labels):
+        """Export a LatencyStats as a summary (_sum, _count) plus a separate _max gauge."""
+        self.add('gauge', name + '_max', f"Largest {help[0].lower()}{help[1:]}", lambda: stats.max, **labels)
+        return self.add('summary', name, help, stats, **labels)
+
+    def histogram(self, name, help, histogram, /, **labels):
+        return self.add('histogram', name, help, histogram, **labels)
+
+    @staticmethod
+    def _labels(labels, **extra):
+        labels = {**labels, **extra}
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
+
+    def render(self):
+        lines = []
+        for name, (kind, help, sources) in self.metrics.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, source in sources:
+                try:
+                    if kind == 'summary':
+                        with source.lock:
+                            total, count = source.total, source.count
+                        lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                        lines.append(f"{name}_count{self._labels(labels)} {count}")
+                    elif kind == 'histogram':
+                        with source.lock:
+                            counts, total, count = list(source.counts), source.total, source.count
+                        cumulative = 0
+                        for bound, n in zip((*source.buckets, '+Inf'), counts):
+                            cumulative += n
+                            lines.append(f"{name}_bucket{self._labels(labels, le=bound)} {cumulative}")
+                        lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                        lines.append(f"{name}_count{self._labels(labels)} {count}")
+                    else:
+                        lines.append(f"{name}{self._labels(labels)} {float(source())}")
+                except Exception as e:
+                    lines.append(f"# {name}{self._labels(labels)} unavailable: {e}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
@@ -4,8 +4,13 @@ import usb.util
 
 class PixelRing:
     TIMEOUT = 8000
+    STATE_COMMANDS = range(0, 7) # trace .. show, each replaces whatever the ring was showing
 
-    def __init__(self, dev = None):
+    def __init__(self, dev = None, scheduler = None, timeout = None):
+        # With a UsbScheduler, writes are queued on its thread instead of blocking the caller
+        self.scheduler = scheduler
+        if timeout:
+            self.TIMEOUT = timeout # ms per control transfer
         try:
             if dev:
                 self.dev = dev
@@ -75,6 +80,14 @@ class PixelRing:
         print('Not support to change pattern')
 
     def write(self, cmd, data=[0]):
+        if self.scheduler is None:
+            self._write(cmd, data)
+        elif cmd in self.STATE_COMMANDS:
+            self.scheduler.submit_led(self._write, cmd, data)
+        else:
+            self.scheduler.submit(self._write, cmd, data, priority=self.scheduler.WRITE)
+
+    def _write(self, cmd, data):
         self.dev.ctrl_transfer(
             usb.util.CTRL_OUT | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE,
             0, cmd, 0x1C, data, self.TIMEOUT)
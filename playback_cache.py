@@ -0,0 +1,169 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import requests
+import config
+
+logger = config.get_logger('rpi')
+
+
+class PlaybackCache:
+    """
+    Content-addressed on-disk LRU cache for TTS clips.
+
+    Clips are stored under the SHA-256 of their bytes and URLs map onto those
+    hashes, so a phrase served under several URLs is stored once. The index is a
+    JSON file next to the clips and survives restarts. Clips small enough are also
+    kept in memory and handed to playbin as data: URIs. Clips queued behind the
+    one playing are prefetched in the background; a clip played straight away is
+    stored from what the player itself downloaded (see store_later()).
+    """
+
+    def __init__(self, directory=config.PLAYBACK_CACHE_DIR, max_bytes=config.PLAYBACK_CACHE_MAX_BYTES,
+                 max_item_bytes=config.PLAYBACK_CACHE_MAX_ITEM_BYTES, memory_item_bytes=config.PLAYBACK_CACHE_MEMORY_ITEM_BYTES,
+                 data_uris=True):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.directory / 'index.json'
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.memory_item_bytes = memory_item_bytes if data_uris else 0
+        self.lock = threading.Lock()
+        self.urls = {} # url: sha256
+        self.entries = {} # sha256: {"file", "size", "content_type", "last_used"}
+        self.memory = {} # sha256: data URI
+        self.fetching = {} # url: Future of its download
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='playback-cache')
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    @property
+    def total_bytes(self):
+        return sum(entry['size'] for entry in self.entries.values())
+
+    def load(self):
+        try:
+            index = json.loads(self.index_path.read_text())
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable playback cache index: {e}")
+            return
+        self.entries = {sha: entry for sha, entry in index.get('entries', {}).items()
+                        if (self.directory / entry['file']).exists()}
+        self.urls = {url: sha for url, sha in index.get('urls', {}).items() if sha in self.entries}
+        for sha, entry in self.entries.items():
+            if entry['size'] <= self.memory_item_bytes:
+                self.memory[sha] = self._data_uri((self.directory / entry['file']).read_bytes(), entry['content_type'])
+        logger.info(f"Playback cache loaded: {len(self.entries)} clips, {self.total_bytes} bytes")
+
+    def save(self):
+        # Caller holds the lock
+        tmp = self.index_path.with_suffix('.tmp')
+        tmp.write_text(json.dumps({'urls': self.urls, 'entries': self.entries}))
+        os.replace(tmp, self.index_path)
+
+    def requested(self, url):
+        """Count a hit or miss for a playback request of url, returns whether it's cached."""
+        with self.lock:
+            cached = url in self.urls
+        if cached:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return cached
+
+    def lookup(self, url):
+        """Local URI for url (data: or file:), or None if it isn't cached (yet)."""
+        with self.lock:
+            sha = self.urls.get(url)
+            if sha is None:
+                return None
+            entry = self.entries[sha]
+            entry['last_used'] = time.time()
+            if sha in self.memory:
+                return self.memory[sha]
+            return (self.directory / entry['file']).resolve().as_uri()
+
+    def prefetch(self, url):
+        """Download url into the cache in the background, if it isn't there or on its way already."""
+        with self.lock:
+            if url in self.urls:
+                return None
+            if url not in self.fetching:
+                self.fetching[url] = self.executor.submit(self._fetch, url)
+            return self.fetching[url]
+
+    def pending(self, url):
+        """Future of url's download if it's still in flight, else None."""
+        with self.lock:
+            return self.fetching.get(url)
+
+    def _fetch(self, url):
+        try:
+            with self.session.get(url, stream=True, timeout=10) as response:
+                response.raise_for_status()
+                if int(response.headers.get('Content-Length') or 0) > self.max_item_bytes:
+                    logger.debug(f"Not caching {url}, larger than {self.max_item_bytes} bytes")
+                    return
+                data = bytearray()
+                for chunk in response.iter_content(64 * 1024):
+                    data += chunk
+                    if len(data) > self.max_item_bytes:
+                        logger.debug(f"Not caching {url}, larger than {self.max_item_bytes} bytes")
+                        return
+                self.store(url, bytes(data), response.headers.get('Content-Type', 'application/octet-stream'))
+        except Exception as e:
+            logger.warning(f"Playback cache fetch failed for {url}: {e}")
+        finally:
+            with self.lock:
+                self.fetching.pop(url, None)
+
+    def store_later(self, url, data, content_type):
+        """store() on the cache thread, for callers that mustn't wait on the disk."""
+        if len(data) <= self.max_item_bytes:
+            self.executor.submit(self.store, url, data, content_type)
+
+    def store(self, url, data, content_type):
+        sha = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if sha not in self.entries:
+                name = sha + Path(url.split('?')[0]).suffix[:8]
+                (self.directory / name).write_bytes(data)
+                self.entries[sha] = {'file': name, 'size': len(data), 'content_type': content_type, 'last_used': time.time()}
+                if len(data) <= self.memory_item_bytes:
+                    self.memory[sha] = self._data_uri(data, content_type)
+            self.urls[url] = sha
+            self.evict()
+            self.save()
+
+    def evict(self):
+        # Caller holds the lock
+        total = self.total_bytes
+        for sha, entry in sorted(self.entries.items(), key=lambda item: item[1]['last_used']):
+            if total <= self.max_bytes:
+                break
+            total -= entry['size']
+            del self.entries[sha]
+            self.memory.pop(sha, None)
+            self.urls = {url: s for url, s in self.urls.items() if s != sha}
+            try:
+                (self.directory / entry['file']).unlink()
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _data_uri(data, content_type):
+        return f"data:{content_type};base64,{base64.b64encode(data).decode()}"
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        with self.lock:
+            self.save()
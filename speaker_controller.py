@@ -5,48 +5,550 @@ import gi
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst, GLib
 import json
+import mimetypes
 import socket
+import asyncio
+import collections
+import threading
+import time
+import numpy as np
 import config
 import logging
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
-from trace_id import with_trace, get_trace_id, set_trace_id
+from trace_id import with_trace, get_trace_id, set_trace_id, spans
+from metrics import LatencyStats, Histogram, registry
+from fastapi.responses import PlainTextResponse
+from playback_cache import PlaybackCache
+from jitter_buffer import JitterBuffer
+from earcons import Earcons
+from codec import ulaw2lin, alaw2lin
 
 
 logger = config.get_logger('rpi')
 Gst.init(None)
 
+PCM_DECODERS = {
+    'pcm_s16le': lambda data: np.frombuffer(data, dtype=np.int16),
+    'mulaw': ulaw2lin,
+    'alaw': alaw2lin,
+}
+PCM_SAMPLE_BYTES = {'pcm_s16le': 2, 'mulaw': 1, 'alaw': 1}
+
+
+class PcmOutput:
+    """
+    appsrc playback pipeline pulling mono S16LE frames from a source with
+    pull(n, out) and drained, like a JitterBuffer or Earcons.
+
+    appsrc only holds a couple of frames, so need-data fires at the sink's pace
+    and the source, not GStreamer's queues, decides how much is buffered.
+    buffer_ms shrinks the audio sink's own buffer, and a source with at_sink()
+    is told the stream time each buffer reaching the sink ends at.
+    """
+    FRAME_MS = 10
+
+    def __init__(self, sample_rate=config.SAMPLE_RATE, buffer_ms=None):
+        self.sample_rate = sample_rate
+        self.frame = sample_rate * self.FRAME_MS // 1000
+        self.out = np.zeros(self.frame, dtype=np.int16)
+        self.buffer_ms = buffer_ms
+        self.pipeline = Gst.parse_launch(
+            f"appsrc name=src format=time max-bytes={self.frame * 4} "
+            f"caps=audio/x-raw,format=S16LE,rate={sample_rate},channels=1,layout=interleaved "
+            f"! audioconvert ! audioresample ! autoaudiosink name=sink")
+        self.src = self.pipeline.get_by_name('src')
+        self.src.connect('need-data', self.on_need_data)
+        if buffer_ms:
+            # autoaudiosink only creates the real sink on the way to READY
+            self.pipeline.connect('deep-element-added', self.on_element_added)
+        self.started = False # Whether the last play() could open the audio device
+        self.probe = None
+        self.source = None
+        self.done = None
+        self.pushed = 0
+        self.gain = 1.0
+        self.trace_id = None
+
+    def play(self, source, loop=None, trace_id=None):
+        """Start playing from source. With a loop, returns a future resolved to source.stats() once it has drained."""
+        self.source = source
+        self.trace_id = trace_id # Until its first real audio is pushed
+        self.done = loop.create_future() if loop else None
+        self.pushed = 0
+        pad = self.pipeline.get_by_name('sink').get_static_pad('sink')
+        if self.probe:
+            pad.remove_probe(self.probe)
+        self.probe = pad.add_probe(Gst.PadProbeType.BUFFER, self.on_sink_buffer, source) if hasattr(source, 'at_sink') else None
+        self.started = self.pipeline.set_state(Gst.State.PLAYING) != Gst.StateChangeReturn.FAILURE
+        return self.done
+
+    def on_element_added(self, pipeline, parent, element):
+        if element.find_property('buffer-time') is not None:
+            element.set_property('buffer-time', self.buffer_ms * 1000)
+            element.set_property('latency-time', min(self.buffer_ms, self.FRAME_MS) * 1000)
+
+    def on_sink_buffer(self, pad, info, source):
+        # Runs on the streaming thread, the buffer is about to enter the sink's ring buffer
+        buffer = info.get_buffer()
+        source.at_sink(buffer.pts + buffer.duration)
+        return Gst.PadProbeReturn.OK
+
+    def on_need_data(self, src, length):
+        # Runs on the appsrc streaming thread
+        source = self.source
+        if source is None:
+            return
+        if source.drained:
+            if self.done is not None:
+                self.done.get_loop().call_soon_threadsafe(SpeakerController.resolve, self.done, source.stats())
+                self.done = None
+            GLib.idle_add(self.stop)
+            return
+        frame = source.pull(self.frame, self.out)
+        if self.trace_id and source.playing:
+            spans.mark('playback_start', self.trace_id)
+            self.trace_id = None
+        if self.gain != 1.0:
+            frame = (frame * self.gain).astype(np.int16)
+        buffer = Gst.Buffer.new_wrapped(frame.tobytes())
+        buffer.pts = self.pushed * Gst.SECOND // self.sample_rate
+        buffer.duration = self.frame * Gst.SECOND // self.sample_rate
+        self.pushed += self.frame
+        src.emit('push-buffer', buffer)
+
+    def interrupt(self):
+        """Drop what's buffered and stop now, resolving the play() future."""
+        source = self.source
+        if source is None:
+            return
+        source.clear()
+        if self.done is not None:
+            self.done.get_loop().call_soon_threadsafe(SpeakerController.resolve, self.done, source.stats())
+            self.done = None
+        self.stop()
+
+    def stop(self):
+        self.source = None
+        self.pipeline.set_state(Gst.State.NULL)
+        return False
+
 class SpeakerController:
-    def __init__(self):
-        self.is_playing = False
-        self.playlist = []
+    """
+    Plays TTS clips through one long-lived playbin.
+
+    The pipeline and its audio sink are created once and parked in READY between
+    responses, so the device isn't renegotiated per clip. URLs queue up in
+    self.playlist, and ones queued behind a clip that's playing are prefetched
+    into the playback cache meanwhile; on about-to-finish the next one is
+    swapped in for gapless playback. Playback never waits on the cache: a clip
+    that isn't cached yet streams from the network, and when nothing is
+    downloading it already, the bytes playbin reads are stored in the cache
+    once the clip has been read to the end.
+
+    In streaming mode network clips start as soon as buffer_ms/buffer_bytes of
+    audio have arrived, and only pause to rebuffer if the buffer drops below
+    rebuffer_percent. Time to first audio is taken when a clip's first buffer
+    reaches the audio sink.
+    """
+
+    def __init__(self, streaming=config.PLAYBACK_STREAMING, buffer_ms=config.PLAYBACK_BUFFER_MS,
+                 buffer_bytes=config.PLAYBACK_BUFFER_BYTES, rebuffer_percent=config.PLAYBACK_REBUFFER_PERCENT):
+        self.playlist = collections.deque()
+        self.current = None # Item playing now
+        self.next_item = None # Item handed to playbin on about-to-finish, not started yet
+        self.awaiting_sink = collections.deque() # Items whose uri was set, in the order their audio reaches the sink
+        self.sink_item = None # Item whose first buffer the sink probe is waiting for
+        self.buffering = False
+        self.rebuffer_percent = rebuffer_percent
+        self.rebuffers = 0
+        self.lock = threading.Lock()
         self.ws = None
+        self.pcm_output = PcmOutput()
+        self.pcm_trace_id = None # Trace of the PCM session playing, if any
+        self.interrupted = collections.deque(maxlen=16) # Trace ids whose remaining audio is dropped
+        self.interrupt_latency = LatencyStats('barge_in_interrupt')
+        self.ducked = False
+        self.first_audio = Histogram('playback_first_audio', buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.5, 5.0))
+        self.register_metrics()
+        # Tiny clips are played from memory through dataurisrc when the plugin is installed
+        self.cache = PlaybackCache(data_uris=Gst.ElementFactory.find('dataurisrc') is not None)
+        self.pipeline = Gst.ElementFactory.make('playbin', 'speaker')
+        sink = Gst.ElementFactory.make('autoaudiosink', None)
+        sink.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER | Gst.PadProbeType.EVENT_DOWNSTREAM, self.on_sink_data)
+        self.pipeline.set_property('audio-sink', sink)
+        if streaming:
+            self.pipeline.set_property('buffer-duration', buffer_ms * Gst.MSECOND)
+            self.pipeline.set_property('buffer-size', buffer_bytes)
+        self.pipeline.connect('about-to-finish', self.on_about_to_finish)
+        self.pipeline.connect('source-setup', self.on_source_setup)
+        self.tee_url = None # Uncached url whose download by playbin goes into the cache
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message", self.on_message)
+        self.pipeline.set_state(Gst.State.READY)
+        # Earcons get their own output that never closes and holds little audio, so a tone starts within a few frames
+        self.earcons = Earcons() if config.EARCONS_ENABLED else None
+        self.earcon_output = None
+        if self.earcons:
+            self.earcon_output = PcmOutput(self.earcons.sample_rate, buffer_ms=config.EARCON_BUFFER_MS)
+            self.earcon_output.play(self.earcons)
+            if not self.earcon_output.started:
+                logger.error("Earcons off: can't open the audio device a second time next to playback, "
+                             "it needs software mixing (PulseAudio, PipeWire or ALSA dmix)")
+                self.earcon_output.stop()
+                self.earcons = self.earcon_output = None
+        # GStreamer bus watches are dispatched by a GLib main loop that lives on its own
+        # thread for the whole process, so playback never blocks the asyncio loop
+        self.glib_loop = GLib.MainLoop()
+        self.glib_thread = threading.Thread(target=self.glib_loop.run, name='glib', daemon=True)
+        self.glib_thread.start()
+
+    @property
+    def is_playing(self):
+        return self.current is not None or bool(self.playlist) or self.pcm_trace_id is not None
+
+    def register_metrics(self):
+        registry.histogram('playback_first_audio_seconds', "Time from a playback request to its first audio at the sink", self.first_audio)
+        registry.counter('playback_rebuffers_total', "Times playback paused to rebuffer", lambda: self.rebuffers)
+        registry.gauge('playback_queue_depth', "Clips waiting to play", lambda: len(self.playlist))
+        registry.counter('playback_cache_hits_total', "Playback cache hits", lambda: self.cache.hits)
+        registry.counter('playback_cache_misses_total', "Playback cache misses", lambda: self.cache.misses)
+        registry.latency('barge_in_interrupt_seconds', "Time from a barge-in to playback stopped or ducked", self.interrupt_latency)
+
+    def enqueue(self, audio_url:str, trace_id:str = None):
+        """Queue audio_url behind whatever is playing, returns a future resolved when it has played."""
+        loop = asyncio.get_running_loop()
+        item = {'url': audio_url, 'trace_id': trace_id or get_trace_id(), 'requested_at': time.monotonic(),
+                'source': None, 'started': False, 'loop': loop, 'done': loop.create_future(),
+                'cached': self.cache.requested(audio_url)}
+        if item['trace_id'] in self.interrupted:
+            # The rest of a response the user talked over
+            logger.info(f"Dropping {audio_url}, its response was interrupted", extra={"trace_id": item['trace_id']})
+            item['done'].set_result(None)
+            return item['done']
+        with self.lock:
+            self.playlist.append(item)
+            idle = self.current is None
+        if idle:
+            GLib.idle_add(self.play_next) # Streams right away, playbin's download fills the cache
+        elif not item['cached']:
+            self.cache.prefetch(audio_url) # Has until the clips ahead of it finish
+        return item['done']
 
     @with_trace
     async def play_audio(self, audio_url:str = None, trace_id:str = None):
-        if not trace_id:
+        """Play audio_url, resolving once it reaches EOS or fails, to its timings."""
+        if trace_id:
             set_trace_id(trace_id)
-        pipeline_str = f"playbin uri={audio_url} audio-sink=\"autoaudiosink\""
-        logger.debug(f"pipeline_str: {pipeline_str}")
-        pipeline = Gst.parse_launch(pipeline_str)
-        pipeline.set_state(Gst.State.PLAYING)
-        loop = GLib.MainLoop()
-        bus = pipeline.get_bus()
-        bus.add_signal_watch()
-        bus.connect("message", self.on_message, loop, pipeline)
-        loop.run()
+        return await self.enqueue(audio_url, get_trace_id())
+
+    def play_earcon(self, name, trace_id=None):
+        """Start earcon name right away, safe to call from the capture path."""
+        if self.earcons:
+            self.earcons.play(name, trace_id or get_trace_id())
+
+    def interrupt(self, mode=config.BARGE_IN_MODE):
+        """
+        Barge-in: stop (or with mode 'duck', turn down) whatever is playing. Returns
+        right away; the time until the output is actually silenced or ducked is
+        logged and kept in interrupt_latency.
+        """
+        requested_at = time.monotonic()
+        with self.lock:
+            traces = {item['trace_id'] for item in (self.current, self.next_item, *self.playlist) if item is not None}
+        if self.pcm_trace_id:
+            traces.add(self.pcm_trace_id)
+        if not traces:
+            return
+        callback = self.duck_now if mode == 'duck' else self.stop_now
+        GLib.idle_add(callback, traces, requested_at, priority=GLib.PRIORITY_HIGH)
+
+    def stop_now(self, traces, requested_at):
+        # Runs on the GLib thread
+        self.interrupted.extend(traces)
+        with self.lock:
+            items = [self.current, self.next_item, *self.playlist]
+            self.current = self.next_item = None
+            self.playlist.clear()
+            self.awaiting_sink.clear()
+            self.sink_item = None
+        self.buffering = False
+        self.pipeline.set_state(Gst.State.READY)
+        self.pcm_output.interrupt()
+        self.observe_interrupt('stopped', traces, requested_at)
+        for item in items:
+            if item is not None:
+                item['interrupted'] = True
+                self.finish(item)
+        return False
+
+    def duck_now(self, traces, requested_at):
+        # Runs on the GLib thread
+        self.ducked = True
+        self.pipeline.set_property('volume', config.BARGE_IN_DUCK_VOLUME)
+        self.pcm_output.gain = config.BARGE_IN_DUCK_VOLUME
+        self.observe_interrupt('ducked', traces, requested_at)
+        return False
 
-    def on_message(self, bus, message, loop, pipe):
+    def unduck(self):
+        if self.ducked:
+            self.ducked = False
+            GLib.idle_add(self.restore_volume)
+
+    def restore_volume(self):
+        self.pipeline.set_property('volume', 1.0)
+        self.pcm_output.gain = 1.0
+        return False
+
+    def observe_interrupt(self, action, traces, requested_at):
+        self.interrupt_latency.observe(time.monotonic() - requested_at)
+        for trace_id in traces:
+            logger.info(f"Barge-in: playback {action} after {self.interrupt_latency.last * 1000:.1f}ms "
+                        f"({self.interrupt_latency.summary()})", extra={"trace_id": trace_id})
+
+    def resolve_uri(self, item):
+        # Looked up as late as possible so a prefetch that finished meanwhile is used
+        uri = self.cache.lookup(item['url'])
+        item['source'] = 'cache' if uri else 'network'
+        if uri is None and self.cache.pending(item['url']) is None:
+            self.tee_url = item['url']
+        logger.debug(f"Playing {item['url']} from {item['source']}")
+        return uri or item['url']
+
+    def on_source_setup(self, playbin, source):
+        # playbin made the element reading the uri; tee what it downloads into the cache
+        url, self.tee_url = self.tee_url, None
+        if url is None or source.find_property('location') is None or source.get_property('location') != url:
+            return
+        tee = {'url': url, 'data': bytearray()}
+        source.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER | Gst.PadProbeType.EVENT_DOWNSTREAM, self.on_source_data, tee)
+
+    def on_source_data(self, pad, info, tee):
+        # Runs on the source's streaming thread
+        data = tee['data']
+        if data is None:
+            return Gst.PadProbeReturn.REMOVE
+        if info.type & Gst.PadProbeType.BUFFER:
+            buffer = info.get_buffer()
+            if buffer.offset != len(data) or len(data) + buffer.get_size() > self.cache.max_item_bytes:
+                tee['data'] = None # Seeked, or too large to cache
+                return Gst.PadProbeReturn.OK
+            data += buffer.extract_dup(0, buffer.get_size())
+        elif info.get_event().type == Gst.EventType.EOS:
+            content_type = mimetypes.guess_type(tee['url'].split('?')[0])[0] or 'application/octet-stream'
+            self.cache.store_later(tee['url'], bytes(data), content_type)
+            tee['data'] = None
+        return Gst.PadProbeReturn.OK
+
+    def play_next(self):
+        # Runs on the GLib thread
+        with self.lock:
+            if self.current is not None or not self.playlist:
+                return False
+            item = self.current = self.playlist.popleft()
+            self.awaiting_sink.append(item)
+        self.pipeline.set_state(Gst.State.READY)
+        self.pipeline.set_property('uri', self.resolve_uri(item))
+        self.pipeline.set_state(Gst.State.PLAYING)
+        return False # One-shot when used as a GLib idle callback
+
+    def on_about_to_finish(self, playbin):
+        # Runs on a streaming thread, setting the uri here makes the switch gapless
+        with self.lock:
+            if not self.playlist:
+                return
+            item = self.next_item = self.playlist.popleft()
+            self.awaiting_sink.append(item)
+        playbin.set_property('uri', self.resolve_uri(item))
+
+    def on_sink_data(self, pad, info):
+        # Runs on the streaming thread for everything reaching the audio sink, keep it cheap
+        if info.type & Gst.PadProbeType.BUFFER:
+            if self.sink_item is not None:
+                self.mark_started(self.sink_item)
+                self.sink_item = None
+        elif info.get_event().type == Gst.EventType.STREAM_START:
+            with self.lock:
+                self.sink_item = self.awaiting_sink.popleft() if self.awaiting_sink else None
+        return Gst.PadProbeReturn.OK
+
+    def on_message(self, bus, message):
+        # Runs on the GLib thread
         t = message.type
-        if t == Gst.MessageType.EOS:
-            print("End of stream")
-            pipe.set_state(Gst.State.NULL)
-            loop.quit()
+        if t == Gst.MessageType.BUFFERING:
+            self.on_buffering(message.parse_buffering())
+        elif t == Gst.MessageType.STREAM_START:
+            with self.lock:
+                finished = None
+                if self.next_item is not None:
+                    finished, self.current, self.next_item = self.current, self.next_item, None
+            if finished:
+                self.finish(finished)
+        elif t == Gst.MessageType.EOS:
+            logger.debug("End of stream")
+            self.end_current()
         elif t == Gst.MessageType.ERROR:
             err, debug = message.parse_error()
             logger.error(f"Error: {err}, {debug}")
-            pipe.set_state(Gst.State.NULL)
-            loop.quit()
+            self.end_current()
+
+    def on_buffering(self, percent):
+        # Start at 100% of the (small) buffer, then only pause again if it nearly runs dry
+        if not self.buffering and percent < 100 and (self.current is None or not self.current['started'] or percent < self.rebuffer_percent):
+            self.buffering = True
+            if self.current is not None and self.current['started']:
+                self.rebuffers += 1
+                logger.warning(f"Playback rebuffering at {percent}% ({self.rebuffers} total)",
+                               extra={"trace_id": self.current['trace_id']})
+            self.pipeline.set_state(Gst.State.PAUSED)
+        elif self.buffering and percent >= 100:
+            self.buffering = False
+            self.pipeline.set_state(Gst.State.PLAYING)
+
+    def end_current(self):
+        with self.lock:
+            finished, self.current = self.current, None
+            if self.next_item is not None: # Never started, put it back in front
+                self.playlist.appendleft(self.next_item)
+                self.next_item = None
+            self.awaiting_sink.clear()
+            self.sink_item = None
+        self.buffering = False
+        self.finish(finished)
+        self.pipeline.set_state(Gst.State.READY) # Keeps the audio sink open
+        self.play_next()
+
+    def mark_started(self, item):
+        if item is None or item['started']:
+            return
+        item['started'] = True
+        now = time.monotonic()
+        item['first_audio'] = now - item['requested_at']
+        spans.mark('playback_start', item['trace_id'], now)
+        self.first_audio.observe(item['first_audio'])
+        logger.info(f"Playback from {item['source']}: first audio after {item['first_audio'] * 1000:.0f}ms "
+                    f"(cache hits={self.cache.hits} misses={self.cache.misses}, queued={len(self.playlist)})",
+                    extra={"trace_id": item['trace_id']})
+
+    def finish(self, item):
+        if item is not None:
+            spans.mark('playback_end', item['trace_id'])
+            timings = {'source': item['source'], 'first_audio': item.get('first_audio'),
+                       'total': time.monotonic() - item['requested_at'], 'interrupted': item.get('interrupted', False)}
+            item['loop'].call_soon_threadsafe(self.resolve, item['done'], timings)
+
+    @staticmethod
+    def resolve(done, result=None):
+        if not done.done():
+            done.set_result(result)
+
+    def shutdown_pipeline(self):
+        self.pipeline.set_state(Gst.State.NULL)
+        with self.lock:
+            items = [self.current, self.next_item, *self.playlist]
+            self.current = self.next_item = None
+            self.playlist.clear()
+            self.awaiting_sink.clear()
+        for item in items:
+            self.finish(item)
+        self.glib_loop.quit()
+        return False
+
+    async def play_pcm(self, websocket: WebSocket):
+        """
+        Play PCM pushed over a WebSocket. The first message is a JSON header like
+        {"sample_rate": 16000, "encoding": "pcm_s16le", "trace_id": "..."} (encoding
+        one of PCM_DECODERS), then binary frames of mono audio, then {"type": "end"}.
+        Jitter buffer stats are sent back once playback has drained. One session
+        plays at a time, others are refused with an error.
+        """
+        try:
+            header = json.loads(await websocket.receive_text())
+            encoding = header.get('encoding', 'pcm_s16le')
+            decode = PCM_DECODERS[encoding]
+            sample_rate = int(header.get('sample_rate', config.SAMPLE_RATE))
+            if not 8000 <= sample_rate <= 48000:
+                raise ValueError(f"unsupported sample_rate {sample_rate}")
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.warning(f"Refusing PCM stream, bad header: {e!r}")
+            return {'error': f"bad header: {e!r}"}
+        trace_id = set_trace_id(header.get('trace_id'))
+        if trace_id in self.interrupted:
+            logger.info("Refusing PCM stream, its response was interrupted", extra={"trace_id": trace_id})
+            return {'interrupted': True}
+        if self.pcm_trace_id is not None:
+            logger.warning(f"Refusing PCM stream, {self.pcm_trace_id} is still playing", extra={"trace_id": trace_id})
+            return {'error': 'busy'}
+        self.pcm_trace_id = trace_id
+        error = None
+        try:
+            if sample_rate != self.pcm_output.sample_rate:
+                GLib.idle_add(self.pcm_output.stop)
+                self.pcm_output = PcmOutput(sample_rate)
+            jitter = JitterBuffer(sample_rate)
+            spans.mark('url', trace_id)
+            done = self.pcm_output.play(jitter, asyncio.get_running_loop(), trace_id)
+            if not self.pcm_output.started:
+                logger.error("Refusing PCM stream, can't open the audio device", extra={"trace_id": trace_id})
+                self.pcm_output.stop()
+                self.pcm_output.done = None
+                self.resolve(done)
+                return {'error': 'audio device unavailable'}
+            logger.info(f"PCM stream started: {header}", extra={"trace_id": trace_id})
+            try:
+                while not done.done(): # Resolved early when interrupted
+                    message = await websocket.receive()
+                    data = message.get('bytes')
+                    if data:
+                        if len(data) % PCM_SAMPLE_BYTES[encoding]:
+                            error = f"{len(data)} byte frame isn't whole {encoding} samples"
+                            logger.warning(f"Ending PCM stream: {error}", extra={"trace_id": trace_id})
+                            break
+                        jitter.push(decode(data))
+                    elif message['type'] == 'websocket.disconnect' or message.get('text'):
+                        break
+            finally:
+                jitter.end()
+            stats = await done
+        finally:
+            self.pcm_trace_id = None
+        stats['interrupted'] = trace_id in self.interrupted
+        if error:
+            stats['error'] = error
+        spans.mark('playback_end', trace_id)
+        logger.info(f"PCM stream finished: {stats}, spans: {spans.finish(trace_id)}", extra={"trace_id": trace_id})
+        return stats
+
+    async def serve(self):
+        """Serve the push-mode playback endpoint on SPEAKER_PORT."""
+        server = uvicorn.Server(uvicorn.Config(create_app(self), host='0.0.0.0', port=config.SPEAKER_PORT, log_level='warning'))
+        server.install_signal_handlers = lambda: None # Ctrl-C belongs to the main app
+        await server.serve()
 
     async def stop(self):
-        pass
+        self.cache.close()
+        GLib.idle_add(self.pcm_output.stop)
+        if self.earcon_output:
+            GLib.idle_add(self.earcon_output.stop)
+        GLib.idle_add(self.shutdown_pipeline)
+
+
+def create_app(speaker):
+    app = FastAPI()
+
+    @app.get('/metrics')
+    async def metrics():
+        return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
+
+    @app.websocket('/pcm')
+    async def pcm(websocket: WebSocket):
+        await websocket.accept()
+        try:
+            stats = await speaker.play_pcm(websocket)
+            await websocket.send_json({'type': 'error' if 'error' in stats else 'stats', **stats})
+            await websocket.close(1008 if 'error' in stats else 1000)
+        except WebSocketDisconnect:
+            pass
+
+    return app
@@ -1,3 +1,7 @@
+import collections
+import inspect
+import threading
+import time
 import uuid
 from contextvars import ContextVar
 from functools import wraps
@@ -23,9 +27,93 @@ def get_trace_id():
 
 def with_trace(func):
     """Decorator to ensure a trace ID is set for the function call."""
+    if inspect.iscoroutinefunction(func):
+        # Set inside the coroutine, so it lands in the context of the task actually running it
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            if trace_id.get() is None:
+                set_trace_id()
+            return await func(*args, **kwargs)
+        return async_wrapper
+
     @wraps(func)
     def wrapper(*args, **kwargs):
         if trace_id.get() is None:
             set_trace_id()
         return func(*args, **kwargs)
-    return wrapper
\ No newline at end of file
+    return wrapper
+
+
+class SpanRecorder:
+    """
+    Timestamps of the milestones of one interaction, keyed by trace ID.
+
+    mark() is cheap and thread-safe, so it can be called from the GStreamer and
+    uplink paths. Each milestone keeps its first timestamp, except playback_end
+    which keeps the last (a response may be several clips). finish() turns a
+    trace into one summary of durations in milliseconds, kept in a ring of the
+    most recent ones.
+    """
+    EVENTS = ('wake', 'first_chunk', 'stop', 'url', 'playback_start', 'playback_end')
+    LAST_WINS = {'playback_end'}
+    # Summary field: (from event, to event)
+    DURATIONS = {
+        'wake_to_first_chunk': ('wake', 'first_chunk'),
+        'speech': ('first_chunk', 'stop'),
+        'server': ('stop', 'url'),
+        'url_to_audio': ('url', 'playback_start'),
+        'response': ('stop', 'playback_start'),
+        'playback': ('playback_start', 'playback_end'),
+        'total': ('wake', 'playback_end'),
+    }
+
+    def __init__(self, capacity=64, max_open=16):
+        self.lock = threading.Lock()
+        self.open = collections.OrderedDict() # trace_id: {event: monotonic time}
+        self.max_open = max_open
+        self.recent = collections.deque(maxlen=capacity)
+
+    def mark(self, event, trace=None, at=None):
+        trace = trace or get_trace_id()
+        if trace is None:
+            return
+        at = at or time.monotonic()
+        evicted = None
+        with self.lock:
+            events = self.open.get(trace)
+            if events is None:
+                events = self.open[trace] = {}
+                if len(self.open) > self.max_open: # Never finished, don't keep it forever
+                    evicted = self.open.popitem(last=False)
+            if event in self.LAST_WINS or event not in events:
+                events[event] = at
+        if evicted:
+            self._summarize(*evicted)
+
+    def finish(self, trace):
+        """Summarize trace and move it to the ring of recent ones, returns the summary."""
+        with self.lock:
+            events = self.open.pop(trace, None)
+        return self._summarize(trace, events) if events else None
+
+    def finish_all(self, keep=None):
+        """Finish every open trace but keep, e.g. interrupted or unanswered ones on the next wake word."""
+        with self.lock:
+            traces = [trace for trace in self.open if trace != keep]
+        return [self.finish(trace) for trace in traces]
+
+    def _summarize(self, trace, events):
+        summary = {'trace_id': trace}
+        for name, (start, end) in self.DURATIONS.items():
+            if start in events and end in events:
+                summary[name] = round((events[end] - events[start]) * 1000, 1)
+        summary['events'] = [event for event in self.EVENTS if event in events]
+        self.recent.append(summary)
+        return summary
+
+    def latest(self, n=None):
+        with self.lock:
+            return list(self.recent)[-n:] if n else list(self.recent)
+
+
+spans = SpanRecorder()
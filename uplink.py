@@ -0,0 +1,230 @@
+import asyncio
+import collections
+import random
+import time
+import websockets
+import config
+from metrics import LatencyStats
+from trace_id import spans
+
+logger = config.get_logger('rpi')
+
+
+class OverflowPolicy:
+    COALESCE = 'coalesce'
+    DROP_OLDEST = 'drop_oldest'
+    END_UTTERANCE = 'end_utterance'
+
+
+class Utterance:
+    START = 'start'
+    STOP = 'stop'
+
+
+class UplinkSender:
+    """
+    Outbound half of the STT WebSocket, and owner of the connection.
+
+    Control messages and encoded audio frames go into one bounded queue, in order,
+    and a single task drains it onto the socket. Capture never awaits the network:
+    when the queue is full the overflow policy decides what gives.
+
+    Everything sent since the last START stays in a bounded replay buffer until the
+    server answers after STOP. If the connection drops, it is re-established with
+    jittered exponential backoff and the buffered utterance is sent again first.
+    """
+
+    def __init__(self, url, capacity=config.UPLINK_QUEUE_FRAMES, policy=config.UPLINK_OVERFLOW_POLICY,
+                 max_bytes=config.UPLINK_QUEUE_MAX_BYTES, replay_max_bytes=config.UPLINK_REPLAY_MAX_BYTES):
+        self.url = url
+        self.ws = None
+        self.connected = asyncio.Event()
+        self.reconnect_task = None
+        self.capacity = capacity
+        self.policy = policy
+        self.max_bytes = max_bytes
+        self.items = collections.deque() # [is_audio, payload, queued_at, utterance, trace_id]
+        self.queued_bytes = 0
+        self.ready = asyncio.Event()
+        self.replay_max_bytes = replay_max_bytes
+        self.unacked = collections.deque()
+        self.unacked_bytes = 0
+        self.in_utterance = False
+        self.awaiting_ack = False
+        self.utterance_trace = None # Set on START until the first audio frame of it is sent
+        self.send_latency = LatencyStats('ws_send')
+        self.queue_latency = LatencyStats('uplink_queue_wait')
+        self.downtime = LatencyStats('ws_downtime')
+        self.max_depth = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.replay_dropped = 0
+        self.bytes_sent = 0
+        self.reconnects = 0
+
+    @property
+    def depth(self):
+        return len(self.items)
+
+    async def connect(self):
+        """Connect, retrying with jittered exponential backoff until it works."""
+        attempt = 0
+        while True:
+            try:
+                self.ws = await websockets.connect(self.url)
+                self.connected.set()
+                return self.ws
+            except Exception as e:
+                delay = random.uniform(0, min(config.UPLINK_RECONNECT_MAX_S, config.UPLINK_RECONNECT_MIN_S * 2 ** attempt))
+                logger.error(f"Failed to connect to WebSocket: {e}, retrying in {delay:.1f}s")
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def wait_connected(self):
+        await self.connected.wait()
+        return self.ws
+
+    def connection_lost(self, ws, reason=None):
+        if ws is not self.ws or not self.connected.is_set():
+            return
+        logger.warning(f"STT WebSocket connection lost: {reason}")
+        self.connected.clear()
+        self.ws = None
+        if self.reconnect_task is None or self.reconnect_task.done():
+            self.reconnect_task = asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        lost_at = time.monotonic()
+        await self.connect()
+        downtime = time.monotonic() - lost_at
+        self.downtime.observe(downtime)
+        self.reconnects += 1
+        # The new server has no state for us, replay the utterance it hasn't answered yet
+        replay = list(self.unacked)
+        self.unacked.clear()
+        self.unacked_bytes = 0
+        for item in reversed(replay):
+            self.items.appendleft(item)
+            self.queued_bytes += len(item[1])
+        if replay:
+            self.ready.set()
+        logger.info(f"Reconnected to STT WebSocket after {downtime:.2f}s (reconnect #{self.reconnects}), "
+                    f"replaying {len(replay)} messages")
+
+    def ack(self):
+        """The server answered, what's been sent for the finished utterance can go."""
+        if self.awaiting_ack:
+            self.awaiting_ack = False
+            self.unacked.clear()
+            self.unacked_bytes = 0
+
+    def put_control(self, payload, utterance=None, trace_id=None):
+        self._append(False, payload, utterance, trace_id)
+
+    def put_audio(self, payload):
+        """Queue an encoded audio frame. Returns False if the utterance should be ended."""
+        payload = bytes(payload) # The codec may hand us a view of a reused buffer
+        if len(self.items) >= self.capacity:
+            if self.policy == OverflowPolicy.END_UTTERANCE:
+                self._drop_audio(all_frames=True)
+                return False
+            if self.policy == OverflowPolicy.COALESCE and self.items[-1][0]:
+                self.items[-1][1] += payload
+                self.queued_bytes += len(payload)
+                self.coalesced += 1
+                self._enforce_byte_limit()
+                return True
+            self._drop_audio()
+        self._append(True, payload)
+        self._enforce_byte_limit()
+        return True
+
+    def _append(self, is_audio, payload, utterance=None, trace_id=None):
+        self.items.append([is_audio, payload, time.monotonic(), utterance, trace_id])
+        self.queued_bytes += len(payload)
+        self.max_depth = max(self.max_depth, len(self.items))
+        self.ready.set()
+
+    def _drop_audio(self, all_frames=False):
+        for item in list(self.items):
+            if item[0]:
+                self.items.remove(item)
+                self.queued_bytes -= len(item[1])
+                self.dropped += 1
+                if not all_frames:
+                    return
+
+    def _enforce_byte_limit(self):
+        while self.queued_bytes > self.max_bytes and any(item[0] for item in self.items):
+            self._drop_audio()
+
+    def _track(self, item):
+        utterance = item[3]
+        if utterance == Utterance.START:
+            self.unacked.clear()
+            self.unacked_bytes = 0
+            self.in_utterance = True
+            self.awaiting_ack = False
+        if not self.in_utterance:
+            return False
+        self.unacked.append(item)
+        self.unacked_bytes += len(item[1])
+        while self.unacked_bytes > self.replay_max_bytes:
+            # Keep the START at the head so a replay still opens a session
+            oldest = next((i for i in self.unacked if i[0]), None)
+            if oldest is None:
+                break
+            self.unacked.remove(oldest)
+            self.unacked_bytes -= len(oldest[1])
+            self.replay_dropped += 1
+        if utterance == Utterance.STOP:
+            self.in_utterance = False
+            self.awaiting_ack = True
+        return True
+
+    async def run(self):
+        while True:
+            if not self.items:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+            ws = await self.wait_connected()
+            item = self.items.popleft()
+            is_audio, payload, queued_at, utterance, trace_id = item
+            self.queued_bytes -= len(payload)
+            tracked = self._track(item)
+            start = time.monotonic()
+            self.queue_latency.observe(start - queued_at)
+            try:
+                await ws.send(payload)
+                self.bytes_sent += len(payload)
+                self._mark_sent(is_audio, utterance, trace_id)
+            except websockets.ConnectionClosed as e:
+                if not tracked:
+                    self.items.appendleft(item)
+                    self.queued_bytes += len(payload)
+                self.connection_lost(ws, e)
+            except Exception as e:
+                logger.error(f"Error sending message: {e}")
+            self.send_latency.observe(time.monotonic() - start)
+
+    def _mark_sent(self, is_audio, utterance, trace_id):
+        if utterance == Utterance.START:
+            self.utterance_trace = trace_id
+        elif utterance == Utterance.STOP:
+            spans.mark('stop', trace_id)
+        elif is_audio and self.utterance_trace:
+            spans.mark('first_chunk', self.utterance_trace)
+            self.utterance_trace = None
+
+    async def close(self):
+        if self.reconnect_task:
+            self.reconnect_task.cancel()
+        if self.ws:
+            await self.ws.close()
+
+    def summary(self):
+        return (f"uplink: depth={self.depth} max_depth={self.max_depth} coalesced={self.coalesced} "
+                f"dropped={self.dropped} bytes_sent={self.bytes_sent} reconnects={self.reconnects} "
+                f"replay_dropped={self.replay_dropped}; {self.send_latency.summary()}; "
+                f"{self.queue_latency.summary()}; {self.downtime.summary()}")
@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import json
+import time
 import struct
 import usb.core
 import usb.util
@@ -9,10 +11,14 @@ import usb.util
 USAGE = """Usage: python {} -h
         -p      show all parameters
         -r      read all parameters
+        --monitor [NAME ...] [--rate HZ]
+                poll parameters at a fixed rate, one JSON line per tick
         NAME    get the parameter with the NAME
         NAME VALUE  set the parameter with the NAME and the VALUE
 """
 
+MONITOR_DEFAULTS = ['VOICEACTIVITY', 'SPEECHDETECTED', 'DOAANGLE', 'RT60']
+
 # parameter list
 # name: (id, offset, type, max, min , r/w, info)
 PARAMETERS = {
@@ -63,8 +69,13 @@ PARAMETERS = {
 class Tuning:
     TIMEOUT = 100000
 
-    def __init__(self, dev):
+    def __init__(self, dev, cache_ttl=0, timeout=None):
         self.dev = dev
+        if timeout:
+            self.TIMEOUT = timeout  # ms per control transfer
+        self.cache_ttl = cache_ttl
+        self.cache = {}  # name: (value, monotonic time read)
+        self.latency = {}  # name: [transfers, total seconds, max seconds, last seconds]
 
     def write(self, name, value):
         try:
@@ -88,11 +99,61 @@ class Tuning:
             0, 0, id, payload, self.TIMEOUT)
 
     def read(self, name):
-        try:
-            data = PARAMETERS[name]
-        except KeyError:
+        """
+        read one parameter from the device, always a fresh transfer
+        """
+        if name not in PARAMETERS:
             return
 
+        start = time.monotonic()
+        value = self._read(name)
+        now = time.monotonic()
+        self.cache[name] = (value, now)
+
+        elapsed = now - start
+        stats = self.latency.setdefault(name, [0, 0.0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+        stats[3] = elapsed
+
+        return value
+
+    def read_many(self, names, max_age=None):
+        """
+        read several parameters, reusing values cached less than max_age seconds ago
+        (defaults to cache_ttl), so a set polled within one tick costs one pass
+        """
+        if max_age is None:
+            max_age = self.cache_ttl
+        now = time.monotonic()
+        values = {}
+        for name in names:
+            cached = self.cache.get(name)
+            if cached is not None and now - cached[1] < max_age:
+                values[name] = cached[0]
+            else:
+                values[name] = self.read(name)
+        return values
+
+    def snapshot(self, names=None, max_age=None):
+        """
+        read_many over all parameters by default
+        """
+        return self.read_many(names if names else sorted(PARAMETERS.keys()), max_age)
+
+    def latency_stats(self):
+        """
+        per-parameter transfer latency in milliseconds
+        """
+        return {
+            name: {'count': n, 'mean_ms': total / n * 1000, 'max_ms': worst * 1000, 'last_ms': last * 1000}
+            for name, (n, total, worst, last) in self.latency.items()
+        }
+
+    def _read(self, name):
+        data = PARAMETERS[name]
+
         id = data[0]
 
         cmd = 0x80 | data[1]
@@ -144,6 +205,42 @@ def find(vid=0x2886, pid=0x0018):
 
     return Tuning(dev)
 
+def monitor(dev, args):
+    names = []
+    rate = 10.0
+    i = 0
+    while i < len(args):
+        if args[i] == '--rate':
+            rate = float(args[i + 1])
+            i += 2
+            continue
+        names.append(args[i].upper())
+        i += 1
+    names = names or MONITOR_DEFAULTS
+    for name in names:
+        if name not in PARAMETERS:
+            print('{} is not a valid name'.format(name))
+            sys.exit(1)
+
+    interval = 1.0 / rate
+    next_tick = time.monotonic()
+    try:
+        while True:
+            start = time.monotonic()
+            values = dev.snapshot(names, max_age=0)
+            line = {
+                'time': time.time(),
+                'values': values,
+                'transfer_ms': {name: round(dev.latency[name][3] * 1000, 3) for name in names},
+                'tick_ms': round((time.monotonic() - start) * 1000, 3),
+            }
+            print(json.dumps(line), flush=True)
+            next_tick += interval
+            time.sleep(max(0, next_tick - time.monotonic()))
+    except KeyboardInterrupt:
+        print(json.dumps({'summary': dev.latency_stats()}), flush=True)
+
+
 def main():
     if len(sys.argv) > 1:
         if sys.argv[1] == '-p':
@@ -163,8 +260,10 @@ def main():
             if sys.argv[1] == '-r':
                 print('{:24} {}'.format('name', 'value'))
                 print('-------------------------------')
-                for name in sorted(PARAMETERS.keys()):
-                    print('{:24} {}'.format(name, dev.read(name)))
+                for name, value in dev.snapshot().items():
+                    print('{:24} {}'.format(name, value))
+            elif sys.argv[1] == '--monitor':
+                monitor(dev, sys.argv[2:])
             else:
                 name = sys.argv[1].upper()
                 if name in PARAMETERS:
@@ -0,0 +1,108 @@
+import asyncio
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import config
+from metrics import LatencyStats
+
+logger = config.get_logger('rpi')
+
+
+class UsbScheduler:
+    """
+    Single owner of the ReSpeaker control transfers.
+
+    One worker thread runs transfers one at a time from a priority queue, so
+    Tuning reads and PixelRing writes never race on the device and nothing
+    blocks the event loop. Latency-critical reads (VAD, DOA) go ahead of LED
+    writes. An LED state write still waiting in the queue is replaced by a newer
+    one, and dropped altogether when it would set the state already shown.
+    """
+    READ = 0
+    WRITE = 5
+    LED = 10
+    KINDS = {READ: 'read', WRITE: 'write', LED: 'led'}
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.pending_led = None # The LED job still waiting in the queue, if any
+        self.led_state = None # LED state sent to the device, or being sent (None if unknown)
+        self.coalesced = 0
+        self.failures = 0
+        self.latency = {kind: LatencyStats(f'usb_{kind}') for kind in self.KINDS.values()}
+        self.transfer = {kind: LatencyStats(f'usb_{kind}_transfer') for kind in self.KINDS.values()}
+        self.running = True
+        self.thread = threading.Thread(target=self._worker, name='usb-scheduler', daemon=True)
+        self.thread.start()
+
+    def submit(self, fn, *args, priority=READ):
+        """Run fn(*args) on the USB thread, returns a concurrent.futures.Future."""
+        future = Future()
+        self.queue.put((priority, next(self.counter), {'fn': fn, 'args': args, 'future': future, 'queued_at': time.monotonic()}))
+        return future
+
+    async def run(self, fn, *args, priority=READ, timeout=None):
+        """Await fn(*args) on the USB thread. On timeout the request is cancelled if it hasn't started."""
+        return await asyncio.wait_for(asyncio.wrap_future(self.submit(fn, *args, priority=priority)), timeout)
+
+    def submit_led(self, write, cmd, data):
+        """Queue an LED state write without waiting for it, coalescing redundant ones."""
+        state = (cmd, tuple(data))
+        with self.lock:
+            if self.pending_led is not None:
+                self.pending_led['args'] = (cmd, data)
+                self.pending_led['state'] = state
+                self.coalesced += 1
+                return
+            if state == self.led_state:
+                self.coalesced += 1
+                return
+            job = {'fn': write, 'args': (cmd, data), 'state': state, 'future': Future(), 'queued_at': time.monotonic()}
+            self.pending_led = job
+        self.queue.put((self.LED, next(self.counter), job))
+
+    def _worker(self):
+        while self.running:
+            priority, _, job = self.queue.get()
+            if job is None:
+                break
+            kind = self.KINDS[priority]
+            if priority == self.LED:
+                with self.lock:
+                    self.pending_led = None
+                    if job['state'] == self.led_state:
+                        self.coalesced += 1
+                        continue
+                    # Claim the state now, so a request arriving during the transfer is compared with it
+                    self.led_state = job['state']
+            future = job['future']
+            if not future.set_running_or_notify_cancel():
+                continue
+            start = time.monotonic()
+            try:
+                result = job['fn'](*job['args'])
+            except Exception as e:
+                self.failures += 1
+                if priority == self.LED:
+                    with self.lock:
+                        self.led_state = None
+                    logger.error(f"USB LED write failed: {e}")
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            end = time.monotonic()
+            self.transfer[kind].observe(end - start)
+            self.latency[kind].observe(end - job['queued_at'])
+
+    def close(self):
+        self.running = False
+        self.queue.put((-1, next(self.counter), None))
+
+    def summary(self):
+        return (f"usb: coalesced={self.coalesced} failures={self.failures} depth={self.queue.qsize()}; "
+                + "; ".join(stats.summary() for stats in self.latency.values()))
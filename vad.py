@@ -0,0 +1,162 @@
+import collections
+import numpy as np
+import config
+
+
+def spectral_features(frames, window, band):
+    """Energy (dBFS) and spectral flatness over band for each row of frames."""
+    x = frames.astype(np.float32)
+    energy_db = 10 * np.log10(np.mean(x * x, axis=1) / (32768.0 ** 2) + 1e-10)
+    power = np.abs(np.fft.rfft(x * window, axis=1))[:, band] ** 2 + 1e-10
+    flatness = np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1)
+    return energy_db, flatness
+
+
+class StreamingVAD:
+    """
+    Host-side voice activity detection on the captured channel.
+
+    Blocks are cut into VAD_FRAME_MS frames and, for all complete frames of a
+    block at once, energy (dBFS), spectral flatness over the speech band and
+    zero-crossing rate are computed. A frame is speech when it stands
+    VAD_MARGIN_DB above an adaptive noise floor and is either spectrally
+    structured or low-frequency dominated, which rejects broadband hiss and fans.
+    `speech` is held for VAD_HANGOVER_MS after the last speech frame and
+    `trailing_silence_ms` counts the time since it, for endpointing.
+    """
+
+    def __init__(self, sample_rate=config.SAMPLE_RATE, frame_ms=config.VAD_FRAME_MS):
+        self.sample_rate = sample_rate
+        self.frame_ms = frame_ms
+        self.frame_size = sample_rate * frame_ms // 1000
+        self.margin_db = config.VAD_MARGIN_DB
+        self.flatness_max = config.VAD_FLATNESS_MAX
+        self.zcr_max = config.VAD_ZCR_MAX
+        self.hangover_frames = max(1, config.VAD_HANGOVER_MS // frame_ms)
+        # Per-frame smoothing factors for the noise floor: quick to fall, slow to rise, slower still under speech
+        self.floor_up = frame_ms / (config.VAD_NOISE_ADAPT_S * 1000)
+        self.floor_up_speech = self.floor_up / 10
+        self.floor_down = 0.2
+        self.window = np.hanning(self.frame_size).astype(np.float32)
+        freqs = np.fft.rfftfreq(self.frame_size, 1 / sample_rate)
+        self.band = (freqs >= 300) & (freqs <= 4000)
+        self.work = np.zeros(self.frame_size * 64, dtype=np.int16)
+        self.pending = 0
+        self.noise_floor_db = None
+        self.hangover = 0
+        self.speech = False
+        self.trailing_silence_ms = 0
+
+    def start_utterance(self):
+        self.trailing_silence_ms = 0
+
+    def features(self, frames):
+        """Energy (dBFS), spectral flatness and zero-crossing rate for each row of frames."""
+        energy_db, flatness = spectral_features(frames, self.window, self.band)
+        zcr = np.count_nonzero(np.diff(np.signbit(frames), axis=1), axis=1) / self.frame_size
+        return energy_db, flatness, zcr
+
+    def process(self, samples):
+        """Feed a block of samples, return the hangover-smoothed decision for each completed frame."""
+        n = self.pending + len(samples)
+        if n > len(self.work):
+            self.work = np.concatenate((self.work[:self.pending], np.zeros(n, dtype=np.int16)))
+        self.work[self.pending:n] = samples
+        count = n // self.frame_size
+        used = count * self.frame_size
+        decisions = np.zeros(count, dtype=bool)
+        if count:
+            energy_db, flatness, zcr = self.features(self.work[:used].reshape(count, self.frame_size))
+            if self.noise_floor_db is None:
+                self.noise_floor_db = float(energy_db[0])
+            candidate = (flatness < self.flatness_max) | (zcr < self.zcr_max)
+            for i in range(count):
+                # The floor recursion is inherently sequential, the rest is vectorized above
+                is_speech = energy_db[i] > self.noise_floor_db + self.margin_db and candidate[i]
+                if energy_db[i] < self.noise_floor_db:
+                    self.noise_floor_db += (energy_db[i] - self.noise_floor_db) * self.floor_down
+                else:
+                    rate = self.floor_up_speech if is_speech else self.floor_up
+                    self.noise_floor_db += (energy_db[i] - self.noise_floor_db) * rate
+                if is_speech:
+                    self.hangover = self.hangover_frames
+                    self.trailing_silence_ms = 0
+                else:
+                    self.trailing_silence_ms += self.frame_ms
+                    if self.hangover:
+                        self.hangover -= 1
+                decisions[i] = is_speech or self.hangover > 0
+            self.speech = bool(decisions[-1])
+        self.pending = n - used
+        self.work[:self.pending] = self.work[used:n]
+        return decisions
+
+
+class WakeGate:
+    """
+    Cheap first stage in front of the wake-word engine.
+
+    For all frames of a block at once, energy and spectral flatness are computed;
+    a frame opens the gate when it stands margin_db above an adaptive noise floor
+    and isn't broadband noise. The gate stays open for hangover_ms, and when it
+    opens the frames of the last lookback_ms are passed first so the engine hears
+    the onset. Everything else is skipped. The margin is deliberately lower than
+    the VAD's: a skipped wake word costs more than a wasted porcupine call.
+    """
+
+    def __init__(self, frame_size, sample_rate=config.SAMPLE_RATE, margin_db=config.WAKE_GATE_MARGIN_DB,
+                 flatness_max=config.WAKE_GATE_FLATNESS_MAX, hangover_ms=config.WAKE_GATE_HANGOVER_MS,
+                 lookback_ms=config.WAKE_GATE_LOOKBACK_MS, adapt_s=config.VAD_NOISE_ADAPT_S):
+        self.frame_size = frame_size
+        frame_ms = frame_size * 1000 / sample_rate
+        self.margin_db = margin_db
+        self.flatness_max = flatness_max
+        self.hangover_frames = max(1, round(hangover_ms / frame_ms))
+        self.lookback = collections.deque(maxlen=max(0, round(lookback_ms / frame_ms)))
+        self.floor_up = frame_ms / (adapt_s * 1000)
+        self.floor_down = 0.2
+        self.window = np.hanning(frame_size).astype(np.float32)
+        freqs = np.fft.rfftfreq(frame_size, 1 / sample_rate)
+        self.band = (freqs >= 300) & (freqs <= 4000)
+        self.noise_floor_db = None
+        self.hangover = 0
+        self.frames = 0
+        self.passed = 0
+
+    def process(self, frames):
+        """
+        Gate the rows of frames, shape (count, frame_size). Returns the (index, frame)
+        pairs to run the engine on, in order; look-back frames from earlier blocks
+        get negative indices.
+        """
+        count = len(frames)
+        if not count:
+            return []
+        energy_db, flatness = spectral_features(frames, self.window, self.band)
+        if self.noise_floor_db is None:
+            self.noise_floor_db = float(energy_db[0])
+        passed = []
+        for i in range(count):
+            loud = energy_db[i] > self.noise_floor_db + self.margin_db and flatness[i] < self.flatness_max
+            rate = self.floor_down if energy_db[i] < self.noise_floor_db else self.floor_up
+            if not loud:
+                self.noise_floor_db += (energy_db[i] - self.noise_floor_db) * rate
+            if loud:
+                self.hangover = self.hangover_frames
+            elif self.hangover:
+                self.hangover -= 1
+            if loud or self.hangover:
+                n = len(self.lookback)
+                passed.extend((i - n + j, frame) for j, frame in enumerate(self.lookback))
+                self.lookback.clear()
+                passed.append((i, frames[i]))
+            elif self.lookback.maxlen:
+                self.lookback.append(frames[i].copy())
+        self.frames += count
+        self.passed += len(passed)
+        return passed
+
+    @property
+    def pass_ratio(self):
+        """Engine calls per frame captured, look-back replays included."""
+        return self.passed / self.frames if self.frames else 1.0